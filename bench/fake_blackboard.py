@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2020  Taylor Smith
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see https://www.gnu.org/licenses/
+
+
+ ~^~
+Fake Blackboard
+    Serves a synthetic Blackboard instance for benchmarking Blackboard
+    Duster without touching a real university server
+Notes: The home page is already "logged in", so the duster goes
+    straight to the course list. Every page and file is generated from
+    its url, so repeated runs see exactly the same site.
+~*~ """
+
+import argparse
+import json
+import time
+
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import quote
+
+# every file claims to have been modified at this time
+lastmod_stamp = 1577872800  # Wed, 01 Jan 2020 10:00:00 GMT
+lastmod = formatdate(lastmod_stamp, usegmt=True)
+# files are sent in pieces this big (bytes)
+chunk_size = 64 * 1024
+
+
+class Site:
+    """shape of the fake Blackboard, and counters of what was served
+
+    'courses': number of courses on the home page
+    'pages': navpane pages per course (plus an ignored Announcements)
+    'files': File items per content page
+    'attachments': attachments on the one Item per content page
+    'folders': Content Folders per content page
+    'depth': how deep Content Folders are nested
+    'size': size of each file (bytes)
+    'latency': delay before every response (seconds)
+    """
+
+    def __init__(self, courses=4, pages=3, files=5, attachments=2,
+                 folders=2, depth=2, size=256 * 1024, latency=0.02):
+        self.courses = courses
+        self.pages = pages
+        self.files = files
+        self.attachments = attachments
+        self.folders = folders
+        self.depth = depth
+        self.size = size
+        self.latency = latency
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {'pages': 0, 'files': 0, 'not_modified': 0,
+                          'redirects': 0, 'bytes': 0}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+
+
+def page(title, body):
+    return (f'<!DOCTYPE html><html><head><title>{title}</title></head>'
+            f'<body>{body}</body></html>').encode()
+
+
+def item(alt, name, href=None, attachments=()):
+    """an li in ul#content_listContainer, shaped like Blackboard's"""
+    # the hidden span is what the real page uses for screen readers
+    title = f'<span class="hideoff">{alt}</span><span style="color:#000">' \
+        f'{name}</span>'
+    if href is not None:
+        title = f'<a href="{href}">{title}</a>'
+    files = ''.join(f'<li><a href="{a_href}"> {a_name}</a></li>'
+                    for a_name, a_href in attachments)
+    if files:
+        files = f'<div class="details"><ul class="attachments clearfix">' \
+            f'{files}</ul></div>'
+    return f'<li><img alt="{alt}" src="/icon.png"><div class="item">' \
+        f'<h3>{title}</h3></div>{files}</li>'
+
+
+def file_href(file_id):
+    return f'/bbcswebdav/xid-{file_id}'
+
+
+def home_page(site):
+    courses = ''.join(
+        f'<li><a href="/course/{c}">Course {c}</a></li>'
+        for c in range(site.courses))
+    return page(
+        'Welcome, Bench – Blackboard Learn',
+        '<button id="agree_button">OK</button>'
+        f'<div id="div_25_1"><div><ul>{courses}</ul></div>'
+        '<div><a href="/announcement">Announcement</a></div></div>')
+
+
+def course_page(site, course):
+    pages = ''.join(
+        f'<li><a href="/course/{course}/page/{p}">'
+        f'<span title="Page {p}">Page {p}</span></a></li>'
+        for p in range(site.pages))
+    return page(
+        f'Course {course}',
+        '<ul id="courseMenuPalette_contents"><li><a href="/announcements">'
+        '<span title="Announcements">Announcements</span></a></li>'
+        f'{pages}</ul>')
+
+
+def content_page(site, course, path):
+    """a content list; path is the list of folder numbers below the
+    navpane page"""
+    prefix = f'c{course}-p' + '.'.join(str(p) for p in path)
+    items = []
+    for f in range(site.files):
+        items.append(item('File', f'File {f}', file_href(f'{prefix}-f{f}')))
+    attachments = [(f'{prefix}-a{a}.pdf', file_href(f'{prefix}-a{a}'))
+                   for a in range(site.attachments)]
+    if attachments:
+        items.append(item('Item', 'Homework', attachments=attachments))
+    if len(path) <= site.depth:
+        base = f'/course/{course}/page/' + '/'.join(str(p) for p in path)
+        for k in range(site.folders):
+            items.append(item('Content Folder', f'Folder {k}',
+                              f'{base}/{k}'))
+    return page(
+        f'Course {course}',
+        f'<ul id="content_listContainer">{"".join(items)}</ul>')
+
+
+class Handler(BaseHTTPRequestHandler):
+    """serves the Site attached to the server"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_html(self, body):
+        self.server.site.count('pages')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, code, headers=()):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        site = self.server.site
+        time.sleep(site.latency)
+        parts = self.path.split('?')[0].strip('/').split('/')
+        try:
+            if parts == ['']:
+                return self.send_html(home_page(site))
+            if parts == ['__stats']:
+                return self.send_html(json.dumps(site.stats).encode())
+            if parts[0] == 'course' and len(parts) == 2:
+                return self.send_html(course_page(site, int(parts[1])))
+            if parts[0] == 'course' and parts[2] == 'page':
+                path = [int(p) for p in parts[3:]]
+                return self.send_html(
+                    content_page(site, int(parts[1]), path))
+            if parts[0] == 'bbcswebdav' and len(parts) == 2:
+                # like the real thing, file links are redirects
+                site.count('redirects')
+                file_id = parts[1][len('xid-'):]
+                return self.send_empty(302, [(
+                    'Location',
+                    f'/bbcswebdav/files/{file_id}/{quote(file_id)}.pdf')])
+            if parts[0] == 'bbcswebdav' and parts[1] == 'files':
+                return self.send_file(parts[2], body)
+        except (IndexError, ValueError):
+            pass
+        self.send_empty(404)
+
+    def send_file(self, file_id, body):
+        site = self.server.site
+        etag = f'"{file_id}"'
+        validators = [('ETag', etag), ('Last-Modified', lastmod),
+                      ('Accept-Ranges', 'bytes')]
+        if self.not_modified(etag):
+            site.count('not_modified')
+            return self.send_empty(304, validators)
+        start, end = 0, site.size - 1
+        code = 200
+        if_range = self.headers.get('If-Range')
+        ranges = self.headers.get('Range', '')
+        if ranges.startswith('bytes=') and if_range in (None, etag, lastmod):
+            first, last = ranges[len('bytes='):].split(',')[0].split('-')
+            start = int(first) if first else max(0, site.size - int(last))
+            if first and last:
+                end = min(int(last), site.size - 1)
+            if start >= site.size:
+                return self.send_empty(
+                    416, [('Content-Range', f'bytes */{site.size}')])
+            code = 206
+        site.count('files')
+        self.send_response(code)
+        for name, value in validators:
+            self.send_header(name, value)
+        if code == 206:
+            self.send_header('Content-Range',
+                             f'bytes {start}-{end}/{site.size}')
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not body:
+            return
+        # the same bytes every time, so hashes match between runs
+        pattern = (file_id.encode() * (chunk_size // len(file_id) + 1))
+        pattern = pattern[:chunk_size]
+        position = start
+        while position <= end:
+            offset = position % chunk_size
+            piece = pattern[offset:offset + end - position + 1]
+            self.wfile.write(piece)
+            position += len(piece)
+        site.count('bytes', end - start + 1)
+
+    def not_modified(self, etag):
+        if 'If-None-Match' in self.headers:
+            return self.headers['If-None-Match'] == etag
+        since = self.headers.get('If-Modified-Since')
+        if since is None:
+            return False
+        try:
+            return parsedate_to_datetime(since).timestamp() >= lastmod_stamp
+        except (TypeError, ValueError):
+            return False
+
+
+def start_server(site, port=0):
+    """serves site on localhost in a background thread
+
+    returns the server; its url is http://127.0.0.1:<server_port>/
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.site = site
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_site_args(parser):
+    """adds the arguments that shape a Site"""
+    defaults = Site()
+    parser.add_argument('--courses', type=int, default=defaults.courses,
+                        help='number of courses')
+    parser.add_argument('--pages', type=int, default=defaults.pages,
+                        help='navpane pages per course')
+    parser.add_argument('--files', type=int, default=defaults.files,
+                        help='File items per content page')
+    parser.add_argument('--attachments', type=int,
+                        default=defaults.attachments,
+                        help='attachments on the Item of each content page')
+    parser.add_argument('--folders', type=int, default=defaults.folders,
+                        help='Content Folders per content page')
+    parser.add_argument('--depth', type=int, default=defaults.depth,
+                        help='how deep Content Folders are nested')
+    parser.add_argument('--size', type=int, default=defaults.size,
+                        help='size of each file (bytes)')
+    parser.add_argument('--latency', type=float, default=defaults.latency,
+                        help='delay before every response (seconds)')
+
+
+def site_from_args(args):
+    return Site(args.courses, args.pages, args.files, args.attachments,
+                args.folders, args.depth, args.size, args.latency)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serves a fake Blackboard instance')
+    parser.add_argument('--port', type=int, default=8025,
+                        help='port to listen on')
+    add_site_args(parser)
+    args = parser.parse_args()
+    server = start_server(site_from_args(args), args.port)
+    print(f'serving a fake Blackboard at http://127.0.0.1:'
+          f'{server.server_port}/ - stats at /__stats, Ctrl-C to stop')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2020  Taylor Smith
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see https://www.gnu.org/licenses/
+
+
+ ~^~
+Blackboard Duster Benchmark
+    Runs blackboard_duster.py against a fake Blackboard twice: a cold
+    run into an empty directory, then a warm run where every file is
+    already downloaded
+Notes: A saved login is written for the duster, so it never waits on
+    the login page. With --no-browser-crawl no browser is started at
+    all; otherwise the WebDriver must be installed. Anything after -- is
+    passed on to the duster, e.g. -- --jobs 8 --no-browser-crawl
+~*~ """
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+from fake_blackboard import add_site_args, site_from_args, start_server
+
+duster_path = Path(__file__).resolve().parent.parent / 'blackboard_duster.py'
+
+
+def run_duster(url, save_dir, duster_args, log_path):
+    """runs the duster to completion
+
+    returns the wall time (seconds) and peak memory (MB) of the run
+    """
+    cmd = [sys.executable, str(duster_path), url, '--auto',
+           '--save', str(save_dir)] + duster_args
+    with log_path.open('a') as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT,
+                                stdin=subprocess.DEVNULL)
+        # wait4 gives the resource usage of just this child
+        _, status, usage = os.wait4(proc.pid, 0)
+        elapsed = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status) \
+        if hasattr(os, 'waitstatus_to_exitcode') else status
+    if proc.returncode != 0:
+        print(f'the duster failed, see "{log_path}"')
+        sys.exit(1)
+    # ru_maxrss is in kilobytes on linux, but bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return elapsed, usage.ru_maxrss / scale
+
+
+def write_session_cache(files_dir):
+    """saves a login for the duster to find
+
+    the fake Blackboard doesn't check cookies, any cookie will do
+    """
+    files_dir.mkdir(parents=True, exist_ok=True)
+    with (files_dir / 'BlackboardDuster.session').open('w') as file:
+        json.dump({'cookies': [{'name': 'bench', 'value': 'bench'}]}, file)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks blackboard_duster.py against a fake'
+        ' Blackboard')
+    add_site_args(parser)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the download directory afterwards')
+    parser.add_argument('duster_args', nargs=argparse.REMAINDER,
+                        help='arguments for the duster, after --')
+    args = parser.parse_args()
+    duster_args = args.duster_args
+    if duster_args[:1] == ['--']:
+        duster_args = duster_args[1:]
+    site = site_from_args(args)
+    server = start_server(site)
+    url = f'http://127.0.0.1:{server.server_port}/'
+    save_dir = Path(tempfile.mkdtemp(prefix='duster-bench-'))
+    log_path = save_dir / 'bench.log'
+    print(f'fake Blackboard at {url}, downloading into "{save_dir}"')
+    write_session_cache(save_dir / 'files')
+    results = []
+    for label in ('cold', 'warm'):
+        site.reset()
+        elapsed, peak = run_duster(url, save_dir / 'files', duster_args,
+                                   log_path)
+        results.append((label, elapsed, peak, dict(site.stats)))
+    server.shutdown()
+    print(f'{"run":<6}{"time s":>9}{"pages/s":>10}{"files/s":>10}'
+          f'{"MB/s":>9}{"peak MB":>10}  requests')
+    for label, elapsed, peak, stats in results:
+        # a 304 still counts as a file that was checked
+        files = stats['files'] + stats['not_modified']
+        print(f'{label:<6}{elapsed:>9.2f}{stats["pages"] / elapsed:>10.1f}'
+              f'{files / elapsed:>10.1f}'
+              f'{stats["bytes"] / elapsed / 1e6:>9.2f}{peak:>10.1f}'
+              f'  {stats}')
+    if not args.keep:
+        for path in sorted(save_dir.rglob('*'), reverse=True):
+            if path.is_dir() and not path.is_symlink():
+                path.rmdir()
+            else:
+                path.unlink()
+        save_dir.rmdir()
+
+
+if __name__ == "__main__":
+    main()
@@ -29,29 +29,61 @@ TODO:
     - dump notes from items/assignments into a .txt : use div.details
     - don't abort if navpane is missing, reload or skip
     - put a 'download progress' label on progress bar
-    - use etag instead of last-modified date (note - etag may not always be available)
 ~*~ """
 
 import argparse
 import json
-import requests
+import os
+import sqlite3
+import sys
 
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    as_completed
 from enum import Enum
-from datetime import datetime
-from os import get_terminal_size
+from datetime import datetime, timedelta, timezone
+from hashlib import sha1, sha256
+from html.parser import HTMLParser
+from os import getpid, link as hard_link
+from email.utils import parsedate_to_datetime
+from fnmatch import fnmatch
 from pathlib import Path
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.common.exceptions import TimeoutException
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
-from urllib.parse import unquote
+from shutil import get_terminal_size
+from random import uniform
+from threading import Lock, get_ident, local
+from time import perf_counter, sleep, time
+from urllib.parse import parse_qsl, unquote, urlencode, urljoin, \
+    urlsplit, urlunsplit
 
 # Last Modified value in the header has a timezone. Once it is
-# converted to a datetime object, the timezone info is lost
-lastmod_parse_fmt = '%a, %d %b %Y %H:%M:%S %Z'
+# converted to a datetime object, it is kept as naive UTC
 lastmod_save_fmt = '%a, %d %b %Y %H:%M:%S'
+# format for sending a date back to the server, HTTP dates are in GMT
+lastmod_send_fmt = '%a, %d %b %Y %H:%M:%S GMT'
+# downloads are written to disk in pieces this big (bytes)
+download_chunk_size = 64 * 1024
+# query parameters Blackboard adds to links that change between visits
+# without changing what the link points to
+volatile_params = {'mode', '_', 'launch_in_new'}
+# commands that only read the history, see history_main()
+history_commands = ['list', 'changed', 'verify']
+
+
+def import_crawl_modules():
+    """imports selenium, requests and asyncio
+
+    they take a while to import and are only needed to crawl, so the
+    history commands never import them
+    """
+    global asyncio, requests, HTTPAdapter, webdriver, TimeoutException, \
+        WebDriverException, WebDriverWait
+    import asyncio
+    import requests
+    from requests.adapters import HTTPAdapter
+    from selenium import webdriver
+    from selenium.common.exceptions import TimeoutException, \
+        WebDriverException
+    from selenium.webdriver.support.ui import WebDriverWait
 
 
 class Link:
@@ -62,7 +94,11 @@ class Link:
     'save_path': relative to download path, usually the page's name
     'element': the selenium Element that the url came from
     'lastmod': last modified date
-    'full_path': full save path, used for troubleshooting
+    'etag': the server's ETag for the file, if it sent one
+    'resolved_url': where url redirected to, saves the redirects later
+    'hash': sha256 of the downloaded file's contents
+    'full_path': full save path, used for troubleshooting and by the
+        history commands
     """
 
     def __init__(self, url, name='', save_path=None, element=None):
@@ -71,34 +107,461 @@ class Link:
         self.save_path = save_path
         self.element = element
         self.lastmod = None
+        self.etag = None
+        self.resolved_url = None
+        self.hash = None
         self.full_path = None
 
     def __repr__(self):
         return f'{self.url}\n\t{self.name}\n\t{self.save_path}'
 
     def set_lastmod(self, datestr):
-        self.lastmod = datetime.strptime(
-            datestr.strip(), lastmod_parse_fmt)
+        # not every server sends a last modified date, and a date that
+        # can't be read is no better than none
+        self.lastmod = None
+        if datestr is None:
+            return
+        try:
+            lastmod = parsedate_to_datetime(datestr.strip())
+        except (TypeError, ValueError):
+            return
+        if lastmod.tzinfo is not None:
+            lastmod = lastmod.astimezone(timezone.utc).replace(tzinfo=None)
+        self.lastmod = lastmod
 
     def json(self):
         result = {
             'url': self.url,
             'name': self.name,
             'save_path': self.save_path.as_posix(),
-            'lastmod': self.lastmod.strftime(lastmod_save_fmt)
+            'lastmod': self.lastmod and self.lastmod.isoformat(),
+            'etag': self.etag,
+            'resolved_url': self.resolved_url,
+            'hash': self.hash,
+            'full_path': self.full_path and self.full_path.as_posix()
         }
         return result
 
 
+class History:
+    """download history, stored in a SQLite database keyed by url
+
+    every change is committed as soon as it is made, so an interrupted
+    run keeps everything it downloaded. Safe to share between threads,
+    and several processes can open the same database.
+
+    'path': location of the database file
+    'read_only': if True, the database is only read, and is never
+        changed - not even to add new tables or columns
+    """
+    # columns in the links table; columns added in newer versions are
+    # added to older databases when they are opened
+    columns = ['url', 'name', 'save_path', 'lastmod', 'etag',
+               'resolved_url', 'hash', 'full_path']
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self.lock = Lock()
+        if read_only:
+            self.conn = sqlite3.connect(
+                Path(path).resolve().as_uri() + '?mode=ro', uri=True,
+                timeout=30, check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row
+            return
+        # other processes may be writing too, wait for them if so
+        self.conn = sqlite3.connect(
+            str(path), timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        # the write-ahead log makes each commit a cheap append
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS links (url TEXT PRIMARY KEY)')
+        found = {row['name'] for row in self.conn.execute(
+            'PRAGMA table_info(links)')}
+        for column in self.columns:
+            if column not in found:
+                self.conn.execute(
+                    f'ALTER TABLE links ADD COLUMN {column} TEXT')
+        # index of file contents, so the same file is only stored once
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS contents ('
+            'hash TEXT PRIMARY KEY, path TEXT, size INTEGER)')
+        # fingerprints of content lists, to skip pages that haven't
+        # changed since their files were last checked
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            'url TEXT PRIMARY KEY, fingerprint TEXT, checked TEXT)')
+        # courses and pages of the current run, so it can be resumed
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS frontier ('
+            'url TEXT PRIMARY KEY, parent TEXT, name TEXT,'
+            ' save_path TEXT, done INTEGER DEFAULT 0)')
+        # how long page elements took to appear, to set wait timeouts
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS waits ('
+            'selector TEXT PRIMARY KEY, times TEXT)')
+        self.conn.commit()
+
+    def get(self, url):
+        """returns the history entry for url as a dict, or None"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT * FROM links WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        if entry['lastmod'] is not None:
+            entry['lastmod'] = datetime.fromisoformat(entry['lastmod'])
+        return entry
+
+    def all(self):
+        """returns every history entry as a dict, in save_path order"""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT * FROM links ORDER BY save_path, name').fetchall()
+        entries = [dict(row) for row in rows]
+        for entry in entries:
+            # a read only history may be missing newer columns
+            for column in self.columns:
+                entry.setdefault(column, None)
+            if entry['lastmod'] is not None:
+                entry['lastmod'] = datetime.fromisoformat(entry['lastmod'])
+        return entries
+
+    def put(self, link):
+        """adds a Link to the history, or updates its entry"""
+        entry = link.json()
+        with profiler.phase('history save'), self.lock, self.conn:
+            self.conn.execute(
+                f'INSERT OR REPLACE INTO links ({", ".join(entry)})'
+                f' VALUES ({", ".join(":" + key for key in entry)})',
+                entry)
+
+    def find_content(self, digest):
+        """returns the Path of a file with the given sha256, or None
+
+        entries for files that were deleted or changed size are dropped
+        """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT path, size FROM contents WHERE hash = ?',
+                (digest,)).fetchone()
+        if row is None:
+            return None
+        path = Path(row['path'])
+        if path.exists() and path.stat().st_size == row['size']:
+            return path
+        with self.lock, self.conn:
+            self.conn.execute(
+                'DELETE FROM contents WHERE hash = ?', (digest,))
+        return None
+
+    def put_content(self, digest, path):
+        """records that path holds the file with the given sha256"""
+        with profiler.phase('history save'), self.lock, self.conn:
+            # whatever was at path before has been replaced
+            self.conn.execute(
+                'DELETE FROM contents WHERE path = ?', (str(path),))
+            self.conn.execute(
+                'INSERT OR REPLACE INTO contents (hash, path, size)'
+                ' VALUES (?, ?, ?)',
+                (digest, str(path), path.stat().st_size))
+
+    def get_page(self, url):
+        """returns a page's fingerprint and when its files were last
+        checked, or (None, None)"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT fingerprint, checked FROM pages WHERE url = ?',
+                (url,)).fetchone()
+        if row is None:
+            return None, None
+        return row['fingerprint'], datetime.fromisoformat(row['checked'])
+
+    def put_page(self, url, fingerprint):
+        """records that every file on a page was just checked"""
+        with profiler.phase('history save'), self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO pages (url, fingerprint, checked)'
+                ' VALUES (?, ?, ?)',
+                (url, fingerprint, datetime.now().isoformat()))
+
+    def add_frontier(self, links, parent):
+        """records Links that the current run still has to go through
+
+        parent: url of the course or page the links were found on, or
+            '' for courses
+        """
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO frontier (url, parent, name,'
+                ' save_path) VALUES (?, ?, ?, ?)',
+                [(link.url, parent, link.name, str(link.save_path))
+                 for link in links])
+
+    def get_frontier(self, parent):
+        """returns the Links recorded under parent, in the order they
+        were found"""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT url, name, save_path FROM frontier'
+                ' WHERE parent = ? ORDER BY rowid', (parent,)).fetchall()
+        return [Link(row['url'], row['name'], Path(row['save_path']))
+                for row in rows]
+
+    def is_done(self, url):
+        """checks if the current run has finished a course or page"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT done FROM frontier WHERE url = ?', (url,)).fetchone()
+        return row is not None and row['done'] == 1
+
+    def mark_done(self, url):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'UPDATE frontier SET done = 1 WHERE url = ?', (url,))
+
+    def get_waits(self):
+        """returns the recorded wait times, keyed by css selector"""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT selector, times FROM waits').fetchall()
+        return {row['selector']: json.loads(row['times']) for row in rows}
+
+    def put_waits(self, waits):
+        """records wait times, keyed by css selector"""
+        with profiler.phase('history save'), self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO waits (selector, times)'
+                ' VALUES (?, ?)',
+                [(selector, json.dumps(times))
+                 for selector, times in waits.items()])
+
+    def clear_frontier(self):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM frontier')
+
+    def import_json(self, path):
+        """copies links from an old JSON history file
+
+        returns the number of links imported
+        """
+        with path.open('r') as file:
+            old_history = json.load(file)
+        entries = []
+        for old_link in old_history['links']:
+            lastmod = datetime.strptime(
+                old_link['lastmod'].strip(), lastmod_save_fmt)
+            entries.append((old_link['url'], old_link['name'],
+                            old_link['save_path'], lastmod.isoformat()))
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO links (url, name, save_path,'
+                ' lastmod) VALUES (?, ?, ?, ?)', entries)
+        return len(entries)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def canonical_url(url):
+    """returns url without the parts that don't change what it points to
+
+    the scheme and host are lower-cased, the fragment and
+    volatile_params are dropped, and the other query parameters are
+    sorted
+    """
+    parts = urlsplit(url)
+    query = sorted(
+        (key, value) for key, value in
+        parse_qsl(parts.query, keep_blank_values=True)
+        if key not in volatile_params)
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                       parts.path or '/', urlencode(query), ''))
+
+
+class Visited:
+    """canonical urls of the pages and files the current run has seen,
+    and how each file turned out
+
+    safe to share between threads
+    """
+
+    def __init__(self):
+        # url: the file's DLResult, or None for pages and unfinished files
+        self.urls = {}
+        self.lock = Lock()
+
+    def add(self, url):
+        """records url, returns False if it was already seen"""
+        url = canonical_url(url)
+        with self.lock:
+            if url in self.urls:
+                return False
+            self.urls[url] = None
+            return True
+
+    def set_result(self, url, res_code):
+        """records how a file turned out"""
+        with self.lock:
+            self.urls[canonical_url(url)] = res_code
+
+    def get_result(self, url):
+        """returns how a file turned out, or None if it hasn't yet"""
+        with self.lock:
+            return self.urls.get(canonical_url(url))
+
+
 class DLResult(Enum):
     """represents various download results"""
     COLLISION = 0
     DOWNLOADED = 1
     DUPLICATE = 2
     UPDATED = 3
+    FAILED = 4
+    SKIPPED = 5
+
+
+class Profiler:
+    """times the slow parts of a run, for --profile
+
+    does nothing until enabled, so the timing calls can stay in place.
+    Each event is tagged with the folder being worked on in its thread
+    (see set_where), which is how time is split up by course and page.
+
+    'enabled': whether events are being recorded
+    'save_root': base directory for downloads, courses are below it
+    'events': a list of dictionaries, one per timed phase or count
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.save_root = None
+        self.events = []
+        self.lock = Lock()
+        self.local = local()
+        self.start = perf_counter()
+
+    def enable(self, save_root, start=None):
+        """starts recording events
+
+        start: the perf_counter() time events are measured from. Worker
+            processes are given the main process's, so their events line
+            up with its own - perf_counter is the same clock for every
+            process on a machine
+        """
+        self.enabled = True
+        self.save_root = save_root
+        self.events = []
+        self.start = perf_counter() if start is None else start
+
+    def set_where(self, path):
+        """sets the folder this thread is working on"""
+        self.local.where = path
+
+    def record(self, event):
+        event['where'] = getattr(self.local, 'where', None)
+        event['pid'] = getpid()
+        event['thread'] = get_ident()
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def phase(self, name):
+        """times the code in a with block"""
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record({'name': name, 'start': start - self.start,
+                         'duration': perf_counter() - start})
+
+    def count(self, name, amount):
+        """records an amount, like the number of bytes written"""
+        if self.enabled:
+            self.record({'name': name, 'start': perf_counter() - self.start,
+                         'amount': amount})
+
+    def get_course(self, where):
+        """returns the course a folder belongs to"""
+        try:
+            return where.relative_to(self.save_root).parts[0]
+        except (AttributeError, IndexError, ValueError):
+            return '(none)'
+
+    def write_trace(self, path, fmt):
+        """saves every event to a file
+
+        fmt: 'jsonl' for one JSON object per line, or 'chrome' for the
+            trace event format that chrome://tracing and Perfetto load
+        """
+        with path.open('w') as file:
+            if fmt == 'jsonl':
+                for event in self.events:
+                    event = dict(event, where=str(event['where']))
+                    file.write(json.dumps(event) + '\n')
+                return
+            trace = []
+            for event in self.events:
+                entry = {
+                    'name': event['name'],
+                    'ts': event['start'] * 1e6,
+                    'pid': event['pid'],
+                    'tid': event['thread'],
+                    'args': {'where': str(event['where'])}
+                }
+                if 'duration' in event:
+                    entry.update(ph='X', dur=event['duration'] * 1e6)
+                else:
+                    entry.update(ph='C', args={event['name']: event['amount']})
+                trace.append(entry)
+            json.dump({'traceEvents': trace}, file)
+
+    def print_summary(self):
+        """prints the time spent per phase and per course"""
+        phases = {}
+        courses = {}
+        amounts = {}
+        for event in self.events:
+            if 'amount' in event:
+                amounts[event['name']] = \
+                    amounts.get(event['name'], 0) + event['amount']
+                continue
+            times = phases.setdefault(event['name'], [])
+            times.append(event['duration'])
+            course = self.get_course(event['where'])
+            courses[course] = courses.get(course, 0) + event['duration']
+        print('Here is where the time went (seconds):')
+        print(f'  {"phase":<16}{"count":>8}{"total":>10}{"mean":>10}'
+              f'{"max":>10}')
+        for name, times in phases.items():
+            print(f'  {name:<16}{len(times):>8}{sum(times):>10.2f}'
+                  f'{sum(times) / len(times):>10.3f}{max(times):>10.3f}')
+        for name, amount in amounts.items():
+            print(f'  {name}: {amount}')
+        print('  by course:')
+        for course, total in sorted(
+                courses.items(), key=lambda item: -item[1]):
+            print(f'    {total:>10.2f}  {course}')
+
 
+# shared by everything that gets timed
+profiler = Profiler()
 
-def apply_style(driver, element, res_code):
+
+# results that leave a file to be tried again next run, so its page
+# can't be skipped as unchanged. Skipped files are not among them, the
+# skip rules are part of the page's fingerprint instead
+retried_results = (DLResult.COLLISION, DLResult.FAILED)
+
+
+def get_style(res_code):
     style = 'border: '
     if res_code == DLResult.COLLISION:
         style += '4px dotted red'
@@ -108,18 +571,60 @@ def apply_style(driver, element, res_code):
         style += '4px dashed cyan'
     elif res_code == DLResult.UPDATED:
         style += '4px solid blue'
+    elif res_code == DLResult.FAILED:
+        style += '4px dotted orange'
+    elif res_code == DLResult.SKIPPED:
+        style += '4px dotted gray'
     else:  # PENDING DOWNLOAD
         style += '1px dotted magenta'
-    driver.execute_script(
-        'arguments[0].setAttribute("style", arguments[1]);',
-        element, style)
+    return style
+
+
+class Highlighter:
+    """marks links on the page to show their download results
+
+    styles are queued and applied together with a single script call,
+    instead of one call to the browser per link
+
+    'driver': the selenium WebDriver showing the page
+    'enabled': if False, nothing is queued or applied
+    'flush_every': apply queued styles once this many have piled up
+    """
+
+    def __init__(self, driver, enabled=True, flush_every=10):
+        self.driver = driver
+        self.enabled = enabled
+        self.flush_every = flush_every
+        self.elements = []
+        self.styles = []
+
+    def queue(self, element, res_code):
+        if not self.enabled or element is None:
+            return
+        self.elements.append(element)
+        self.styles.append(get_style(res_code))
+        if len(self.elements) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.elements:
+            return
+        self.driver.execute_script(
+            'for (var i = 0; i < arguments[0].length; i++) {'
+            ' arguments[0][i].setAttribute("style", arguments[1][i]); }',
+            self.elements, self.styles)
+        self.elements = []
+        self.styles = []
 
 
 def parse_args():
     navpane_ignore = {'Announcements', 'Calendar',
                       'My Grades', 'Blackboard Collaborate'}
     parser = argparse.ArgumentParser(
-        description='Scrapes files from Blackboard courses')
+        description='Scrapes files from Blackboard courses',
+        epilog='To look through your download history instead, use' +
+        f' one of the commands {", ".join(history_commands)} in place' +
+        ' of BB_base_URL, e.g. "list -h"')
     parser.add_argument(
         'bb_url', metavar='BB_base_URL',
         help='URL for your Blackboard instance.')
@@ -127,20 +632,73 @@ def parse_args():
         '-s', '--save', metavar='path', default='.',
         help='directory to save your downloads in')
     parser.add_argument(
-        '--historypath', '--history', metavar='json',
-        default='BlackboardDuster.json',
-        help='path to blackboard duster history file. Relative to' +
-        ' download directory unless path is absolute. The file' +
-        ' will be created if it does not exit.')
+        '--historypath', '--history', metavar='file',
+        default='BlackboardDuster.db',
+        help='path to blackboard duster history database. Relative' +
+        ' to download directory unless path is absolute. The file' +
+        ' will be created if it does not exit. An old .json history' +
+        ' file is imported into a database next to it.')
+    parser.add_argument(
+        '--session-cache', metavar='file',
+        default='BlackboardDuster.session',
+        help='where your login cookies are saved, so later runs can' +
+        ' skip logging in until they expire. Relative to download' +
+        ' directory unless path is absolute. Anyone who can read' +
+        ' this file can use your Blackboard account! It is only' +
+        ' readable by you')
+    parser.add_argument(
+        '--no-session-cache', action='store_true',
+        help='always log in, and do not save your login cookies')
     parser.add_argument(
         '--delay', metavar='delay_mult', type=int, default=1,
         help='multiplier for sleep/delays')
+    parser.add_argument(
+        '-j', '--jobs', metavar='N', type=int, default=1,
+        help='number of files to download at the same time')
+    parser.add_argument(
+        '--split-size', metavar='MB', type=float, default=50,
+        help='files at least this big are downloaded in parts at the' +
+        ' same time, if the server allows it. 0 never splits files.' +
+        ' Defaults to 50')
+    parser.add_argument(
+        '--split-parts', metavar='N', type=int, default=4,
+        help='how many parts to split big files into. Defaults to 4')
+    parser.add_argument(
+        '--retries', metavar='N', type=int, default=3,
+        help='how many times to try a failed request again, waiting' +
+        ' longer each time. Defaults to 3')
+    parser.add_argument(
+        '--timeout', metavar='seconds', type=float, default=60,
+        help='give up on a request (and maybe try again) if the server' +
+        ' sends nothing for this long. Defaults to 60')
+    parser.add_argument(
+        '--rate', metavar='N', type=float, default=0,
+        help='most requests per second to send to a server, to stay' +
+        ' under your school\'s rate limits. Defaults to 0, no limit')
     parser.add_argument(
         '-w', '--webdriver', '--wd', metavar='name', default='firefox',
         help='browser WebDriver to use - either "firefox" or' +
         ' "chrome". You must have the WebDriver in your system' +
         ' path. Currently, only firefox is supported; that' +
         ' will change in the future')
+    parser.add_argument(
+        '--browsers', metavar='N', type=int, default=1,
+        help='number of browsers to crawl courses with. Extra' +
+        ' browsers are headless, and split the courses between' +
+        ' them; turns on auto mode. Ignored with --no-browser-crawl')
+    parser.add_argument(
+        '-r', '--resume', action='store_true',
+        help='pick up where an interrupted run stopped, skipping' +
+        ' courses and pages it already finished')
+    parser.add_argument(
+        '--max-depth', metavar='N', type=int, default=10,
+        help='how many folders deep to go into a page. Defaults to 10')
+    parser.add_argument(
+        '--max-age', metavar='days', type=float, default=7,
+        help='files on a page that has not changed since the last' +
+        ' run are not checked again, unless they were last checked' +
+        ' more than this many days ago. 0 always checks every file.' +
+        ' Defaults to 7')
     parser.add_argument(
         '-a', '--auto', action='store_true',
         help='disable user input. The script will continue after' +
@@ -149,6 +707,62 @@ def parse_args():
         '-b', '--binary', metavar='file', default=None,
         help='Path to the binary you want to use - use if your' +
         ' browser binary is not in the default location')
+    parser.add_argument(
+        '--lean', action='store_true',
+        help='make the browser faster and lighter: images, fonts,' +
+        ' audio and video are not loaded, and pages are read before' +
+        ' they finish loading. The browser is hidden when your saved' +
+        ' login still works')
+    parser.add_argument(
+        '--pipeline', action='store_true',
+        help='read pages and download files at the same time, instead' +
+        ' of waiting for every file on a page before moving on. Turns' +
+        ' on auto mode; download results are not highlighted')
+    parser.add_argument(
+        '--no-browser-crawl', action='store_true',
+        help='only use the browser to log in and find your courses;' +
+        ' course pages are read with plain HTTP requests instead.' +
+        ' Much faster, but nothing is highlighted')
+    parser.add_argument(
+        '--no-highlight', action='store_true',
+        help='do not highlight links on the page to show download' +
+        ' results. Saves time in auto mode, when nobody is watching')
+    parser.add_argument(
+        '--keep-versions', action='store_true',
+        help='when a file is updated, keep the old version next to' +
+        ' it (named with its last modified date) instead of' +
+        ' replacing it')
+    parser.add_argument(
+        '--profile', metavar='file', default=None,
+        help='time page loads, waits, downloads and history saves,' +
+        ' save every timing to this file and print a summary at' +
+        ' the end')
+    parser.add_argument(
+        '--profile-format', choices=['jsonl', 'chrome'], default='jsonl',
+        help='format of the --profile file: JSON lines, or the chrome' +
+        ' trace format (chrome://tracing, Perfetto). Defaults to jsonl')
+    parser.add_argument(
+        '--course', metavar='name', action='append', default=[],
+        help='only go through this course; repeat this argument to go' +
+        ' through several courses')
+    parser.add_argument(
+        '--skip-course', metavar='name', action='append', default=[],
+        help='do not go through this course; repeat this argument to' +
+        ' skip several courses')
+    parser.add_argument(
+        '--skip-ext', metavar='ext', action='append', default=[],
+        help='do not download files with this extension, like "mp4";' +
+        ' repeat this argument to skip several extensions')
+    parser.add_argument(
+        '--skip-glob', metavar='pattern', action='append', default=[],
+        help='do not download files whose name, or path in the' +
+        ' download directory, matches this pattern, like' +
+        ' "*/Lectures/*.mov"; repeat this argument to skip several' +
+        ' patterns')
+    parser.add_argument(
+        '--max-size', metavar='MB', type=float, default=0,
+        help='do not download files bigger than this. Defaults to 0,' +
+        ' no limit')
     parser.add_argument(
         '-i', '--ignore', metavar='name', action='append',
         help=f'Name of a page in the navpane to ignore; repeat this argument' +
@@ -156,12 +770,36 @@ def parse_args():
     args = parser.parse_args()
     # convert given path string into a Path object
     args.save = Path(args.save)
+    # requests needs to know the scheme
+    if '://' not in args.bb_url:
+        args.bb_url = 'https://' + args.bb_url
     # if history path isn't absolute, make it relative to save
     args.historypath = Path(args.historypath)
     if not args.historypath.is_absolute():
         args.historypath = args.save / args.historypath
+    # same for the session cache
+    if args.no_session_cache:
+        args.session_cache = None
+    else:
+        args.session_cache = Path(args.session_cache)
+        if not args.session_cache.is_absolute():
+            args.session_cache = args.save / args.session_cache
+    if args.profile is not None:
+        args.profile = Path(args.profile)
     # sterilize webdriver name
     args.webdriver = args.webdriver.lower().strip()
+    # at least one download worker is needed
+    args.jobs = max(1, args.jobs)
+    args.retries = max(0, args.retries)
+    args.timeout = max(1, args.timeout)
+    args.max_depth = max(0, args.max_depth)
+    # the pipeline and background browsers never stop to wait on a page
+    args.browsers = max(1, args.browsers)
+    if args.no_browser_crawl:
+        args.browsers = 1
+    if args.pipeline or args.browsers > 1:
+        args.auto = True
+    args.skip_ext = {ext.lower().lstrip('.') for ext in args.skip_ext}
     # combine args.ignore with navpane_ignore
     if args.ignore:
         navpane_ignore.update(args.ignore)
@@ -172,40 +810,440 @@ def parse_args():
 # end parse_args()
 
 
-def wait_on_CSS_selector(driver, selector, delay_mult, delay):
-    """delay until an element is located by the given css selector"""
+class Waiter:
+    """sets wait timeouts from how long each element took to appear
+
+    until a selector has been found a few times, waits are as long as
+    they always were (scaled by delay_mult). After that, the timeout is
+    a few times the 95th percentile of how long it took, so a missing
+    element doesn't hold things up. Times are kept in the history, so
+    the next run starts out knowing them.
+
+    'delay_mult': delay multiplier
+    'history': a History to load and save the times, or None
+    'times': recent waits for each selector, in seconds - None for a
+        wait that timed out
+    """
+    keep = 50
+    min_found = 5
+    min_missed = 3
+    margin = 3
+
+    def __init__(self, delay_mult, history=None):
+        self.delay_mult = delay_mult
+        self.history = history
+        self.times = history.get_waits() if history is not None else {}
+        # only save what changed, other browsers may be saving too
+        self.changed = set()
+
+    def timeout(self, selector, delay):
+        """how long to wait for selector, at most delay_mult * delay"""
+        longest = self.delay_mult * delay
+        shortest = min(self.delay_mult, longest)
+        times = self.times.get(selector, [])
+        found = sorted(time for time in times if time is not None)
+        if not found and len(times) >= self.min_missed:
+            # it hasn't shown up lately, don't count on it
+            return shortest
+        if len(found) < self.min_found:
+            return longest
+        p95 = found[round(0.95 * (len(found) - 1))]
+        return min(longest, max(shortest, self.margin * p95))
+
+    def record(self, selector, time):
+        times = self.times.setdefault(selector, [])
+        times.append(time)
+        del times[:-self.keep]
+        self.changed.add(selector)
+
+    def save(self):
+        if self.history is not None:
+            self.history.put_waits(
+                {selector: self.times[selector] for selector in self.changed})
+            self.changed.clear()
+
+    def is_known_empty(self, page_link):
+        """checks the history for a page that had no content last time"""
+        if self.history is None:
+            return False
+        fingerprint, _ = self.history.get_page(page_link.url)
+        return fingerprint == empty_fingerprint
+
+
+def wait_on_CSS_selector(driver, selector, waiter, delay, empty=False):
+    """delay until an element is located by the given css selector
+
+    waiter: a Waiter, which sets the timeout
+    delay: longest wait in seconds, before delay_mult
+    empty: if True, the element is probably not on this page, so stop
+        waiting once the page has been read
+    returns True if the element was found
+    """
+    def located(driver):
+        if driver.find_elements_by_css_selector(selector):
+            return 'found'
+        # images may still be loading, but the page has been read
+        if empty and driver.execute_script(
+                'return document.readyState') != 'loading':
+            return 'empty'
+        return False
+
+    start = perf_counter()
     try:
-        WebDriverWait(driver, delay_mult * delay).until(
-            EC.presence_of_element_located((
-                By.CSS_SELECTOR, selector))
-        )
+        with profiler.phase('selector wait'):
+            result = WebDriverWait(
+                driver, waiter.timeout(selector, delay)).until(located)
     except TimeoutException:
+        waiter.record(selector, None)
+        return False
+    if result == 'empty':
         return False
+    waiter.record(selector, perf_counter() - start)
     return True
 # end wait_on_CSS_selector
 
 
-def setup_history(path):
-    # set up the download history JSON object
-    history = None
-    try:
-        with path.open('r') as file:
-            history = json.load(file)
-    except json.decoder.JSONDecodeError:
-        print('current history file will not parse, aborting')
+# file types that are never needed to read a page, blocked by --lean
+lean_blocked_urls = [
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot',
+    '*.mp3', '*.mp4', '*.webm', '*.ogg', '*.wav'
+]
+
+
+def get_ff_profile(args, headless=False):
+    """returns FirefoxOptions for args
+
+    headless: if True, the browser runs without a window
+    """
+    options = webdriver.FirefoxOptions()
+    options.headless = headless
+    if args.binary is not None:
+        options.binary_location = args.binary
+    if args.lean:
+        # 2 means blocked
+        options.set_preference('permissions.default.image', 2)
+        if headless:
+            # nobody is looking, so the page doesn't need to look nice
+            options.set_preference('permissions.default.stylesheet', 2)
+        options.set_preference('gfx.downloadable_fonts.enabled', False)
+        options.set_preference('browser.display.use_document_fonts', 0)
+        # 5 blocks audio and video from playing by themselves
+        options.set_preference('media.autoplay.default', 5)
+        options.set_preference('media.autoplay.blocking_policy', 2)
+        # don't wait for images and frames to finish loading
+        options.set_capability('pageLoadStrategy', 'eager')
+    return options
+
+
+def get_ch_options(args, headless=False):
+    """returns ChromeOptions for args
+
+    headless: if True, the browser runs without a window
+    """
+    options = webdriver.ChromeOptions()
+    options.headless = headless
+    if args.binary is not None:
+        options.binary_location = args.binary
+    if args.lean:
+        # 2 means blocked
+        prefs = {'profile.managed_default_content_settings.images': 2}
+        if headless:
+            # nobody is looking, so the page doesn't need to look nice
+            prefs['profile.managed_default_content_settings.stylesheets'] = 2
+        options.add_experimental_option('prefs', prefs)
+        options.add_argument('--blink-settings=imagesEnabled=false')
+        options.add_argument('--autoplay-policy=user-gesture-required')
+        options.add_argument('--mute-audio')
+        # don't wait for images and frames to finish loading
+        options.set_capability('pageLoadStrategy', 'eager')
+    return options
+
+
+def setup_driver(args, headless=False):
+    """starts the WebDriver named by args.webdriver
+
+    headless: if True, the browser runs without a window
+    exits if the WebDriver isn't supported
+    """
+    driver = None
+    if args.webdriver == 'firefox':
+        driver = webdriver.Firefox(options=get_ff_profile(args, headless))
+    elif args.webdriver == 'chrome':
+        driver = webdriver.Chrome(options=get_ch_options(args, headless))
+        if args.lean:
+            # chrome has no setting to block fonts and media, so block
+            # them through the devtools protocol instead
+            driver.execute_cdp_cmd('Network.enable', {})
+            driver.execute_cdp_cmd(
+                'Network.setBlockedURLs', {'urls': lean_blocked_urls})
+    else:
+        print(
+            f'sorry, but {args.webdriver} is not a supported WebDriver. Aborting')
         exit()
-    except IOError:
-        print('history file not found, creating new history')
-        history = json.loads('{"links":[]}')
+    # choose a nice size - the navpane is invisible at small widths,
+    # but selenium can still see its elements
+    driver.set_window_size(600, 500)
+    return driver
+
+
+def setup_history(path):
+    """opens the download history database
+
+    path: the history database. If it doesn't exist yet but an old
+        JSON history file does (either the given path or one with the
+        same name ending in .json), the old file is imported once
+    returns a History object
+    """
+    if path.suffix == '.json':
+        json_path = path
+        path = path.with_suffix('.db')
+    else:
+        json_path = path.with_suffix('.json')
+    is_new = not path.exists()
+    if is_new:
+        print('history database not found, creating new history')
+        path.parent.mkdir(parents=True, exist_ok=True)
+    history = History(path)
+    if is_new and json_path.exists():
+        print(f'importing old history file "{json_path}"')
+        try:
+            count = history.import_json(json_path)
+        except (json.decoder.JSONDecodeError, KeyError, ValueError):
+            print('old history file will not parse, aborting')
+            history.close()
+            path.unlink()
+            exit()
+        print(f'imported {count} links from the old history')
     return history
 
 
-def setup_session(driver):
-    """copies login cookies from WebDriver into a requests session"""
+class TokenBucket:
+    """limits how often something happens, while allowing short bursts
+
+    'rate': tokens added per second, and the most that can be saved up
+    'tokens': tokens available now; negative if waits are queued
+    'updated': when tokens was last topped up
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = perf_counter()
+        self.lock = Lock()
+
+    def take(self):
+        """takes a token, waiting for one if there are none left
+
+        returns how long it waited, in seconds
+        """
+        with self.lock:
+            now = perf_counter()
+            self.tokens = min(
+                self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # the token is claimed now, so other threads queue behind
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+
+class Transport:
+    """a requests Session that retries and limits its own request rate
+
+    failed GETs (connection errors, timeouts, 429 and 5xx statuses) are
+    tried again after an exponential backoff with jitter, or as long as
+    the server's Retry-After header asks. Requests to each host are
+    limited with a TokenBucket.
+
+    'session': the requests Session, with blackboard cookies
+    'retries': how many times a failed request is tried again
+    'rate': requests per second to each host, 0 for no limit
+    'timeout': (connect, read) timeout in seconds for every request
+        that doesn't set its own. The read timeout also applies to each
+        read of a streamed body
+    'retried': number of requests that were tried again
+    'throttled': number of requests that waited on the rate limit or
+        were told to slow down by the server
+    """
+    retry_statuses = {429, 500, 502, 503, 504}
+    # seconds; backoff doubles from backoff_base up to backoff_max
+    backoff_base = 0.5
+    backoff_max = 30
+    retry_after_max = 300
+    # seconds; connecting never needs longer than this
+    connect_timeout = 10
+
+    def __init__(self, session, retries=3, rate=0, timeout=60):
+        self.session = session
+        self.retries = retries
+        self.rate = rate
+        self.timeout = (min(self.connect_timeout, timeout), timeout)
+        self.buckets = {}
+        self.lock = Lock()
+        self.retried = 0
+        self.throttled = 0
+
+    def throttle(self, url):
+        """waits until another request may be sent to url's host"""
+        if self.rate <= 0:
+            return
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate)
+            bucket = self.buckets[host]
+        if bucket.take() > 0:
+            with self.lock:
+                self.throttled += 1
+
+    def backoff(self, attempt):
+        """returns a random delay before retry number attempt"""
+        # "full jitter" keeps workers that failed together from
+        # retrying together
+        return uniform(0, min(
+            self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def retry_after(self, response):
+        """returns the delay the server asked for in seconds, or None"""
+        value = response.headers.get('retry-after')
+        if value is None:
+            return None
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                delay = (parsedate_to_datetime(value) -
+                         datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                return None
+        return min(self.retry_after_max, max(0, delay))
+
+    def wait_to_retry(self, attempt, response=None):
+        """counts a retry, and sleeps before it"""
+        delay = None
+        if response is not None:
+            delay = self.retry_after(response)
+        if delay is None:
+            delay = self.backoff(attempt)
+        with self.lock:
+            self.retried += 1
+            if response is not None and response.status_code == 429:
+                self.throttled += 1
+        with profiler.phase('retry wait'):
+            sleep(delay)
+
+    def get(self, url, **kwargs):
+        """sends a GET with the session, retrying if it fails
+
+        returns the response; if every try failed, it is the last
+        failed response, or the last exception is raised
+        """
+        # without a timeout, a stalled connection would hang forever
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            self.throttle(url)
+            try:
+                response = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+                self.wait_to_retry(attempt)
+                continue
+            if response.status_code not in self.retry_statuses or \
+                    attempt == self.retries:
+                return response
+            response.close()
+            self.wait_to_retry(attempt, response)
+
+
+def setup_session(cookies, args):
+    """copies login cookies into a requests session
+
+    cookies: cookies from a WebDriver's get_cookies(), or the session
+        cache
+    args: the parsed arguments object; there is a connection for each
+        of the args.jobs download workers (or each part of a split
+        download), plus one for the crawler
+    returns a Transport around the session
+    """
     session = requests.Session()
-    for cookie in driver.get_cookies():
+    adapter = HTTPAdapter(
+        pool_maxsize=args.jobs * max(1, args.split_parts) + 1)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    for cookie in cookies:
         session.cookies.set(cookie['name'], cookie['value'])
-    return session
+    # each browser process has its own session, so they share the rate
+    return Transport(session, args.retries, args.rate / args.browsers,
+                     args.timeout)
+
+
+def add_cookies(driver, cookies):
+    """copies login cookies into a WebDriver
+
+    cookies can only be set for the site that is loaded, so load the
+    Blackboard page first
+    """
+    for cookie in cookies:
+        try:
+            driver.add_cookie({
+                key: cookie[key] for key in
+                ('name', 'value', 'path', 'domain', 'secure', 'expiry')
+                if key in cookie
+            })
+        except WebDriverException:
+            # belongs to another site, like a single sign-on server
+            pass
+
+
+def save_session_cache(path, cookies):
+    """saves login cookies, readable only by the current user"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # the file may have been created with looser permissions before
+    os.chmod(path, 0o600)
+    with os.fdopen(fd, 'w') as file:
+        json.dump({'cookies': cookies}, file)
+
+
+def load_session_cache(path):
+    """returns the saved login cookies that haven't expired, or None"""
+    try:
+        with path.open('r') as file:
+            cookies = json.load(file)['cookies']
+    except (IOError, ValueError, KeyError):
+        return None
+    now = time()
+    cookies = [cookie for cookie in cookies
+               if cookie.get('expiry') is None or cookie['expiry'] > now]
+    return cookies or None
+
+
+def is_home_title(title):
+    """checks for the title of the Blackboard home page"""
+    # looking for "Welcome, #### – Blackboard Learn" (the dash is NOT a
+    # minus sign!)
+    return title.startswith('Welcome, ') and \
+        title.endswith(' – Blackboard Learn')
+
+
+def check_session(session, bb_url):
+    """checks that a session is logged in, with a single request
+
+    returns the parsed home page and its url, or None if the session
+    isn't logged in
+    """
+    try:
+        response = session.get(bb_url, timeout=30)
+    except requests.RequestException:
+        return None
+    root = parse_html(response.text)
+    title = root.find('title')
+    if title is None or not is_home_title(title.text):
+        return None
+    return root, response.url
 
 
 def manual_login(driver):
@@ -213,139 +1251,206 @@ def manual_login(driver):
 
      waits until the Blackboard homepage appears, returns nothing
      """
+    if is_home_title(driver.title):
+        return
     print('Please log into your university Blackboard account - I will'
           ' wait for you to reach the home page!')
-    # looking for "Welcome, #### – Blackboard Learn" (the dash is NOT a
-    # minus sign!)
-    while not driver.title.startswith('Welcome, ') or \
-            not driver.title.endswith(' – Blackboard Learn'):
-        pass
+    # check a couple times a second, there's no hurry
+    while not is_home_title(driver.title):
+        sleep(0.5)
 
 
-def accept_cookies(driver, delay_mult):
+def accept_cookies(driver, waiter):
     """if the cookie notice appears, click 'accept'"""
-    try:
-        element = WebDriverWait(driver, delay_mult * 4).until(
-            EC.presence_of_element_located((By.ID, 'agree_button'))
-        )
+    if wait_on_CSS_selector(driver, '#agree_button', waiter, 4):
         print('I am accepting the cookie notice, I hope that is ok!')
-        element.click()
-    except TimeoutException:
+        driver.find_element_by_id('agree_button').click()
+    else:
         print('I did not see a cookie notice.')
 
 
-def get_courses_info(driver, delay_mult, save_root):
+# the page scraping below is done with one script per page, since
+# every find_element or get_attribute call is a round trip to the browser
+courses_script = """
+return Array.from(document.querySelectorAll(
+    'div#div_25_1 > div > ul > li > a'
+)).map(function (a) {
+    return {name: a.innerText, href: a.href};
+});
+"""
+
+navpane_script = """
+return Array.from(document.querySelectorAll(
+    'ul#courseMenuPalette_contents a'
+)).map(function (a) {
+    var span = a.querySelector('span');
+    return {name: span ? span.getAttribute('title') : null, href: a.href};
+});
+"""
+
+# arguments[0]: whether to return the link elements, for highlighting
+content_list_script = """
+var withElements = arguments[0];
+return Array.from(document.querySelectorAll(
+    'ul#content_listContainer > li'
+)).map(function (li) {
+    var img = li.querySelector('img');
+    // in the header holding the name there is a hidden <span> that
+    // gets in the way; ignore it by looking for the style attribute
+    var name = li.querySelector('span[style]');
+    var anchor = li.querySelector('a');
+    var attachments = [];
+    li.querySelectorAll('ul.attachments > li').forEach(function (file) {
+        var a = file.querySelector('a');
+        if (a) {
+            attachments.push({
+                name: a.innerText.trim(),
+                href: a.href,
+                element: withElements ? a : null
+            });
+        }
+    });
+    return {
+        type: img ? img.getAttribute('alt') : null,
+        name: name ? name.innerText : null,
+        href: anchor ? anchor.href : null,
+        element: withElements ? anchor : null,
+        attachments: attachments
+    };
+});
+"""
+
+
+def get_courses_info(driver, waiter, save_root):
     """returns an array of link objects for each course
 
     driver: a selenium WebDriver
-    delay_mult: delay multiplier
+    waiter: a Waiter
     save_root: base directory for downloads
     expects homepage to already be loaded
     """
-    result = []
     # TODO course announcements are included in the list
     if not wait_on_CSS_selector(
-            driver,'div#div_25_1 a',delay_mult,10):
+            driver,'div#div_25_1 a',waiter,10):
         print('I did not see your course list! Aborting')
         driver.quit()
         exit()
     # be more specific when selecting the links - the wait statement's
     # selector includes announcement links, which we don't want
-    course_links = driver.find_elements_by_css_selector(
-        'div#div_25_1 > div > ul > li > a')
-    for c_l in course_links:
+    return links_from_courses(driver.execute_script(courses_script),
+                              save_root)
+
+
+def links_from_courses(courses, save_root):
+    """builds Links from the courses scraped out of the home page
+
+    courses: a list of dictionaries, as returned by courses_script
+    save_root: base directory for downloads
+    returns a Link array
+    """
+    result = []
+    for course in courses:
         link = Link(
-            c_l.get_attribute('href'),
-            c_l.text,
-            (save_root / c_l.text)
+            course['href'],
+            course['name'],
+            (save_root / course['name'])
         )
         result.append(link)
     return result
 
 
-def get_navpane_info(driver, course_link, delay_mult):
+def get_navpane_info(driver, course_link, waiter):
     """returns an array of Links for items in the navpane
 
     driver: a selenium WebDriver
     course_link: Link object representing the course homepage - this
         link will be loaded
-    delay_mult: delay multiplier
+    waiter: a Waiter
     returns a Link array
     """
-    driver.get(course_link.url)
+    with profiler.phase('page load'):
+        driver.get(course_link.url)
     if not wait_on_CSS_selector(
-            driver,'ul#courseMenuPalette_contents',delay_mult,10):
+            driver,'ul#courseMenuPalette_contents',waiter,10):
         print('I could not access the navpane! skipping')
         return []
-    page_link_elements = driver.find_elements_by_css_selector(
-        'ul#courseMenuPalette_contents a')
+    with profiler.phase('extract'):
+        pages = driver.execute_script(navpane_script)
+    return links_from_navpane(course_link, pages)
+
+
+def links_from_navpane(course_link, pages):
+    """builds Links from the pages scraped out of a navpane
+
+    course_link: Link object for the course the navpane belongs to
+    pages: a list of dictionaries, as returned by navpane_script
+    returns a Link array
+    """
     result = []
-    for element in page_link_elements:
-        title = element.find_element_by_css_selector(
-            'span').get_attribute('title')
+    for page in pages:
         link = Link(
-            element.get_attribute('href'),
-            title,
-            (course_link.save_path / title)
+            page['href'],
+            page['name'],
+            (course_link.save_path / page['name'])
         )
         result.append(link)
     return result
 
 
-def gather_links(page_link, driver, delay_mult=1):
-    """gathers and highlights available file urls on the given page
+def get_fingerprint(items):
+    """hashes the names, types, hrefs and attachments of scraped items
 
-    page should already be loaded
+    element handles are left out, they change every time
+    """
+    summary = [
+        [item['type'], item['name'], item['href'],
+         [[file['name'], file['href']] for file in item['attachments']]]
+        for item in items
+    ]
+    return sha256(json.dumps(summary).encode()).hexdigest()
 
-    driver: a selenium WebDriver
-    page_link: Link object
-    delay_mult: delay multiplier
+
+# the fingerprint of a page with nothing on it
+empty_fingerprint = get_fingerprint([])
+
+
+def links_from_items(page_link, items):
+    """builds Links from the items scraped out of a content list
+
+    page_link: Link object for the page the items came from
+    items: a list of dictionaries, as returned by content_list_script
 
     returns a dictionary:
         links: a list of Link objects
         folders: a list of sub-folders on the page
+        fingerprint: a hash of the items, to tell if the page changed
     """
     results = {
         'links': [],
-        'folders': []
+        'folders': [],
+        'fingerprint': get_fingerprint(items)
     }
-    if not wait_on_CSS_selector(
-            driver,'ul#content_listContainer',delay_mult,3):
-        print('This page does not have a content list.')
-        return results
-    # get a list of all items in the content list
-    page_content = driver.find_elements_by_css_selector(
-        'ul#content_listContainer > li')
-    for item in page_content:
-        i_type = item.find_element_by_css_selector(
-            'img').get_attribute('alt')
-        # in the header holding the name there is a hidden <span> that
-        # gets in the way; ignore it by looking for the style attribute
-        try:
-            i_name = item.find_element_by_css_selector(
-                    'span[style]').text
-        except:
+    for item in items:
+        i_type = item['type']
+        i_name = item['name']
+        if i_name is None:
             print('failed to find item name. Skipping... ')
             continue
         # print(f'    {i_type}: {i_name}'
         if i_type == 'File':
             # files are just a link
-            link_element = item.find_element_by_css_selector(
-                'a')
             link = Link(
-                link_element.get_attribute('href'),
+                item['href'],
                 i_name,
                 page_link.save_path,
-                link_element
+                item.get('element')
             )
-            apply_style(driver, link.element, None)
             results['links'].append(link)
         elif i_type == 'Content Folder':
             # folders contain another page
             # no need to track its element
             link = Link(
-                item.find_element_by_css_selector(
-                    'a').get_attribute('href'),
+                item['href'],
                 i_name,
                 (page_link.save_path / i_name)
             )
@@ -363,197 +1468,1543 @@ def gather_links(page_link, driver, delay_mult=1):
                   ' type - attachments will still be collected **')
 
         # find attachments; Items and Assignments usually have some
-        i_files = item.find_elements_by_css_selector(
-            'ul.attachments > li')
+        i_files = item['attachments']
         # if there are multiple attachments on the item, stick them in
         # a new folder
         save_path = page_link.save_path
         if len(i_files) > 1:
             save_path = save_path / i_name
         for file in i_files:
-            link_element = file.find_element_by_css_selector('a')
             link = Link(
-                link_element.get_attribute('href'),
-                file.find_element_by_css_selector('a').text.strip(),
+                file['href'],
+                file['name'],
                 save_path,
-                link_element
+                file.get('element')
             )
             # print(f'     - {link.name}')
-            apply_style(driver, link.element, None)
             results['links'].append(link)
     return results
 
 
-def dowload_file(session, link, history):
-    """uses requests to download a file"""
-    # set up download result code
-    res_code = DLResult.DOWNLOADED
-    # get the link's last modified date
-    response = session.head(link.url, allow_redirects=True)
-    link.set_lastmod(response.headers['last-modified'])
-    # look for link in history
-    dupe = None
-    for hist_link in history['links']:
-        if link.url == hist_link['url']:
-            dupe = hist_link
-            continue
-    # compare link's last modified date to historical date
-    if dupe is not None:
-        hist_lastmod = datetime.strptime(
-            dupe['lastmod'].strip(), lastmod_save_fmt)
-        if link.lastmod <= hist_lastmod:
-            return DLResult.DUPLICATE
-        else:
-            res_code = DLResult.UPDATED
-    # download the file
-    result = session.get(link.url)
-    # setup the file's full path and create any needed directories
-    link.save_path.mkdir(parents=True, exist_ok=True)
-    file_name = unquote(result.url.rsplit('/', 1)[1])
-    file_path = link.save_path / file_name
-    try:
-        with file_path.open('xb') as file:
-            file.write(result.content)
-        # FIXME updated files still trigger exception
-    except:
-        # hang onto the full path to report it later
-        link.full_path = file_path
-        res_code = DLResult.COLLISION
-        # TODO hash the two files to see if they are the same
-        # FIXME collided files are still added to history, collision is forgotten
-    # add link to history or update lastmod
-    if dupe is None:
-        history['links'].append(link.json())
-    else:
-        dupe['lastmod'] = link.lastmod.strftime(lastmod_parse_fmt)
-    return res_code
+def gather_links(page_link, driver, waiter, highlighter=None):
+    """gathers and highlights available file urls on the given page
 
+    page should already be loaded
 
-def download_links(links, driver, session, history):
-    """uses requests to download files, shows a progress bar
+    driver: a selenium WebDriver
+    page_link: Link object
+    waiter: a Waiter; pages it knows are empty aren't waited on
+    highlighter: a Highlighter; if None or disabled, link elements
+        aren't fetched
 
-    driver: a WebDriver object
-    links: a list of Link objects
-    history: a JSON object with prevoius download history
-    returns a list of counters
+    returns a dictionary:
+        links: a list of Link objects
+        folders: a list of sub-folders on the page
     """
-    # set up download tracking variables
-    counters = [0]*len(DLResult)
-    # watch for collisions
-    collided = []
-    # set progress bar length
-    prog_len = get_terminal_size().columns-2
-    for count, link in enumerate(links):
-        res_code = dowload_file(session, link, history)
-        counters[res_code.value] += 1
-        # mark link to indicate download result to user
-        apply_style(driver, link.element, res_code)
-        # if it's a collision, hang onto the link
-        if res_code == DLResult.COLLISION:
-            collided.append(link)
-        # draw progress bar
-        progress = (count + 1) * int(prog_len / len(links))
-        print('|{}{}|'.format('#'*progress, '-'*(prog_len-progress)),
-              end='\r')
+    if not wait_on_CSS_selector(
+            driver,'ul#content_listContainer',waiter,3,
+            waiter.is_known_empty(page_link)):
+        print('This page does not have a content list.')
+        return links_from_items(page_link, [])
+    highlight = highlighter is not None and highlighter.enabled
+    # get all items in the content list with a single script
+    with profiler.phase('extract'):
+        items = driver.execute_script(content_list_script, highlight)
+    results = links_from_items(page_link, items)
+    if highlight:
+        for link in results['links']:
+            highlighter.queue(link.element, None)
+        highlighter.flush()
+    return results
+
+
+class HTMLNode:
+    """an element of a page parsed by PageParser
+
+    'tag': the element's tag name
+    'attrs': a dictionary of the element's attributes
+    'children': a list of child HTMLNodes and text strings
+    """
+
+    def __init__(self, tag, attrs):
+        self.tag = tag
+        self.attrs = dict(attrs)
+        self.children = []
+
+    def matches(self, tag, id=None, cls=None, attr=None):
+        """checks the element against a simple css selector
+
+        tag#id.cls[attr], where id, cls and attr are optional
+        """
+        return self.tag == tag and \
+            (id is None or self.attrs.get('id') == id) and \
+            (cls is None or cls in (self.attrs.get('class') or '').split()) and \
+            (attr is None or attr in self.attrs)
+
+    def child_elements(self, tag, **kwargs):
+        """returns matching elements directly below this one"""
+        return [child for child in self.children
+                if isinstance(child, HTMLNode) and
+                child.matches(tag, **kwargs)]
+
+    def find_all(self, tag, **kwargs):
+        """returns matching elements anywhere below this one, in
+        document order"""
+        result = []
+        for child in self.children:
+            if isinstance(child, HTMLNode):
+                if child.matches(tag, **kwargs):
+                    result.append(child)
+                result.extend(child.find_all(tag, **kwargs))
+        return result
+
+    def find(self, tag, **kwargs):
+        """returns the first matching element below this one, or None"""
+        for child in self.children:
+            if isinstance(child, HTMLNode):
+                if child.matches(tag, **kwargs):
+                    return child
+                found = child.find(tag, **kwargs)
+                if found is not None:
+                    return found
+        return None
+
+    @property
+    def text(self):
+        """all text below this element, with whitespace collapsed"""
+        parts = []
+        for child in self.children:
+            parts.append(child.text if isinstance(child, HTMLNode)
+                         else child)
+        return ' '.join(''.join(parts).split())
+
+
+class PageParser(HTMLParser):
+    """builds a tree of HTMLNodes out of a page
+
+    Blackboard leaves some tags unclosed, so a closing tag also closes
+    any elements opened after the matching one
+    """
+    void_tags = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img',
+                 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+    # opening one of these closes an open one of the same kind, unless
+    # one of its containers was opened in between
+    implied_end = {'li': {'ul', 'ol'}, 'option': {'select'},
+                   'tr': {'table'}, 'td': {'tr'}, 'th': {'tr'}}
+
+    def __init__(self):
+        super().__init__()
+        self.root = HTMLNode('document', [])
+        self.stack = [self.root]
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.implied_end:
+            for i in range(len(self.stack) - 1, 0, -1):
+                if self.stack[i].tag in self.implied_end[tag]:
+                    break
+                if self.stack[i].tag == tag:
+                    del self.stack[i:]
+                    break
+        node = HTMLNode(tag, attrs)
+        self.stack[-1].children.append(node)
+        if tag not in self.void_tags:
+            self.stack.append(node)
+
+    def handle_startendtag(self, tag, attrs):
+        self.stack[-1].children.append(HTMLNode(tag, attrs))
+
+    def handle_endtag(self, tag):
+        for i in range(len(self.stack) - 1, 0, -1):
+            if self.stack[i].tag == tag:
+                del self.stack[i:]
+                return
+
+    def handle_data(self, data):
+        self.stack[-1].children.append(data)
+
+
+def parse_html(text):
+    """returns the root HTMLNode of a page"""
+    parser = PageParser()
+    parser.feed(text)
+    parser.close()
+    return parser.root
+
+
+def scrape_courses(root, base_url):
+    """does the same job as courses_script, for a parsed page"""
+    courses = []
+    course_list = root.find('div', id='div_25_1')
+    if course_list is None:
+        return courses
+    for div in course_list.child_elements('div'):
+        for ul in div.child_elements('ul'):
+            for li in ul.child_elements('li'):
+                for a in li.child_elements('a'):
+                    courses.append({
+                        'name': a.text.strip(),
+                        'href': urljoin(base_url, a.attrs.get('href', ''))
+                    })
+    return courses
+
+
+def scrape_navpane(root, base_url):
+    """does the same job as navpane_script, for a parsed page
+
+    returns None if the page has no navpane
+    """
+    navpane = root.find('ul', id='courseMenuPalette_contents')
+    if navpane is None:
+        return None
+    pages = []
+    for a in navpane.find_all('a'):
+        span = a.find('span')
+        pages.append({
+            'name': span.attrs.get('title') if span else None,
+            'href': urljoin(base_url, a.attrs.get('href', ''))
+        })
+    return pages
+
+
+def scrape_content_list(root, base_url):
+    """does the same job as content_list_script, for a parsed page
+
+    returns None if the page has no content list
+    """
+    content_list = root.find('ul', id='content_listContainer')
+    if content_list is None:
+        return None
+    items = []
+    for li in content_list.child_elements('li'):
+        img = li.find('img')
+        # skip the hidden <span>, like content_list_script does
+        name = li.find('span', attr='style')
+        anchor = li.find('a')
+        attachments = []
+        for ul in li.find_all('ul', cls='attachments'):
+            for file in ul.child_elements('li'):
+                a = file.find('a')
+                if a is not None:
+                    attachments.append({
+                        'name': a.text,
+                        'href': urljoin(base_url, a.attrs.get('href', ''))
+                    })
+        items.append({
+            'type': img.attrs.get('alt') if img else None,
+            'name': name.text if name else None,
+            'href': urljoin(base_url, anchor.attrs.get('href', ''))
+            if anchor else None,
+            'attachments': attachments
+        })
+    return items
+
+
+class BrowserCrawler:
+    """reads course pages with a selenium WebDriver
+
+    'driver': the selenium WebDriver
+    'waiter': a Waiter
+    'highlighter': a Highlighter for the WebDriver
+    """
+
+    def __init__(self, driver, waiter, highlighter):
+        self.driver = driver
+        self.waiter = waiter
+        self.highlighter = highlighter
+
+    def navpane(self, course_link):
+        profiler.set_where(course_link.save_path)
+        return get_navpane_info(self.driver, course_link, self.waiter)
+
+    def gather(self, page_link):
+        profiler.set_where(page_link.save_path)
+        with profiler.phase('page load'):
+            self.driver.get(page_link.url)
+        return gather_links(
+            page_link, self.driver, self.waiter, self.highlighter)
+
+
+class LoginExpired(Exception):
+    """raised when Blackboard sends its login page instead of the page
+    that was asked for"""
+
+
+def is_login_page(root, url):
+    """checks if a parsed page is Blackboard's (or a single sign-on
+    server's) login page"""
+    if '/webapps/login' in urlsplit(url).path:
+        return True
+    return any(node.attrs.get('type') == 'password'
+               for node in root.find_all('input'))
+
+
+class HTTPCrawler:
+    """reads course pages with plain requests, no browser needed
+
+    after logging in, the navpane and content lists are static html,
+    so they can be fetched with the session and parsed directly. There
+    is nothing to highlight, so the highlighter is always disabled.
+
+    'session': a Transport, with blackboard cookies
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.highlighter = Highlighter(None, enabled=False)
+
+    def fetch(self, url):
+        """returns the parsed page and the url it ended up at
+
+        raises a requests.RequestException if the server sent an error
+        or couldn't be reached, even after retrying, and LoginExpired if
+        it sent the login page
+        """
+        with profiler.phase('page load'):
+            response = self.session.get(url)
+        response.raise_for_status()
+        with profiler.phase('extract'):
+            root = parse_html(response.text)
+        if is_login_page(root, response.url):
+            raise LoginExpired(url)
+        return root, response.url
+
+    def navpane(self, course_link):
+        profiler.set_where(course_link.save_path)
+        try:
+            root, base_url = self.fetch(course_link.url)
+        except requests.RequestException as error:
+            print(f'I could not load the navpane ({error})! skipping')
+            return []
+        pages = scrape_navpane(root, base_url)
+        if pages is None:
+            print('I could not access the navpane! skipping')
+            return []
+        return links_from_navpane(course_link, pages)
+
+    def gather(self, page_link):
+        """returns the page's links like gather_links, or None if the
+        page could not be loaded"""
+        profiler.set_where(page_link.save_path)
+        try:
+            root, base_url = self.fetch(page_link.url)
+        except requests.RequestException as error:
+            print(f'I could not load this page ({error}), I will try' +
+                  ' again next time.')
+            return None
+        items = scrape_content_list(root, base_url)
+        if items is None:
+            print('This page does not have a content list.')
+            items = []
+        return links_from_items(page_link, items)
+
+
+def get_part_path(link, validator):
+    """returns where the partial download of a link is kept
+
+    the name is built from the link's url and the validator (ETag or
+    Last-Modified value) the download started with, so a partial file
+    is only resumed if the file on the server is the same version.
+    Partial files left behind by older versions are deleted.
+    """
+    url_hash = sha1(link.url.encode()).hexdigest()[:16]
+    val_hash = sha1(validator.encode()).hexdigest()[:16]
+    part_path = link.save_path / f'.{url_hash}-{val_hash}.part'
+    for old_path in link.save_path.glob(f'.{url_hash}-*.part'):
+        if old_path != part_path:
+            old_path.unlink()
+    return part_path
+
+
+def hash_file(path, hasher=None):
+    """feeds a file into a sha256 hasher, returns the hasher"""
+    if hasher is None:
+        hasher = sha256()
+    with path.open('rb') as file:
+        for chunk in iter(lambda: file.read(download_chunk_size), b''):
+            hasher.update(chunk)
+    return hasher
+
+
+def write_chunks(result, part_path, mode, hasher):
+    """writes a streamed response into part_path, hashing it on the way
+
+    only download_chunk_size bytes are held in memory at a time
+    returns the hasher
+    """
+    written = 0
+    with profiler.phase('download'), part_path.open(mode) as file:
+        for chunk in result.iter_content(download_chunk_size):
+            file.write(chunk)
+            hasher.update(chunk)
+            written += len(chunk)
+    profiler.count('bytes written', written)
+    return hasher
+
+
+def stream_to_file(session, url, part_path, validator):
+    """streams url into part_path, resuming where a previous try stopped
+
+    validator: ETag or Last-Modified value of the file; the server will
+        send the whole file instead of the rest if it has changed
+    returns the sha256 of the whole file
+    """
+    headers = {}
+    if part_path.exists():
+        headers['Range'] = f'bytes={part_path.stat().st_size}-'
+        headers['If-Range'] = validator
+    with session.get(url, headers=headers, stream=True) as result:
+        if result.status_code == 416:
+            # the partial file doesn't line up with the server's file
+            part_path.unlink()
+            return stream_to_file(session, url, part_path, validator)
+        # the session has already retried, give up on this file
+        result.raise_for_status()
+        # 206 means the server is sending the rest of the file
+        if result.status_code == 206:
+            hasher = hash_file(part_path)
+            mode = 'ab'
+        else:
+            hasher = sha256()
+            mode = 'wb'
+        return write_chunks(result, part_path, mode, hasher).hexdigest()
+
+
+def is_unchanged(link, hist_link):
+    """compares a Link's validators with its history entry
+
+    for servers that answer a conditional request with the whole file
+    """
+    if link.etag is not None and hist_link['etag'] is not None:
+        return link.etag == hist_link['etag']
+    if link.lastmod is not None and hist_link['lastmod'] is not None:
+        return link.lastmod <= hist_link['lastmod']
+    # nothing to compare, so download it and compare the contents
+    return False
+
+
+def conditional_get(session, link, hist_link):
+    """requests a file, unless it hasn't changed since it was recorded
+
+    a single GET replaces the old HEAD-then-GET check. The stored ETag
+    and Last-Modified values are sent as validators, and the location
+    the link redirected to last time is used to skip the redirects.
+    returns a streamed response, which is 304 if the file is unchanged
+    """
+    headers = {}
+    url = link.url
+    if hist_link is not None:
+        if hist_link['etag'] is not None:
+            headers['If-None-Match'] = hist_link['etag']
+        if hist_link['lastmod'] is not None:
+            headers['If-Modified-Since'] = \
+                hist_link['lastmod'].strftime(lastmod_send_fmt)
+        if hist_link['resolved_url'] is not None:
+            url = hist_link['resolved_url']
+    response = session.get(url, headers=headers, stream=True)
+    if url != link.url and response.status_code >= 400:
+        # the saved location went stale, follow the redirects again
+        response.close()
+        response = session.get(link.url, headers=headers, stream=True)
+    return response
+
+
+def get_version_path(file_path, lastmod):
+    """returns where an old version of a file is kept, named with its
+    last modified date"""
+    stamp = lastmod.strftime('%Y-%m-%d %H%M%S') if lastmod else 'old'
+    return file_path.with_name(
+        f'{file_path.stem} ({stamp}){file_path.suffix}')
+
+
+def place_file(part_path, link, hist_link, history, keep_versions):
+    """moves a finished download to link.full_path
+
+    files are compared by their sha256 (link.hash): a file that's
+    already in place, or stored somewhere else, is not stored again,
+    and an older version of the same link is replaced (or kept next
+    to it if keep_versions).
+    returns a DLResult
+    """
+    file_path = link.full_path
+    res_code = DLResult.DOWNLOADED if hist_link is None else DLResult.UPDATED
+    if file_path.exists():
+        on_disk = hash_file(file_path).hexdigest()
+        if on_disk == link.hash:
+            part_path.unlink()
+            return DLResult.DUPLICATE
+        if hist_link is None or hist_link['hash'] not in (None, on_disk):
+            # the file in the way isn't the one this link downloaded
+            # last time - it's someone else's, or it has been edited
+            part_path.unlink()
+            return DLResult.COLLISION
+        if keep_versions:
+            file_path.replace(
+                get_version_path(file_path, hist_link['lastmod']))
+        part_path.replace(file_path)
+    else:
+        same_path = history.find_content(link.hash)
+        if same_path is not None:
+            try:
+                # point at the copy that is already stored
+                hard_link(same_path, file_path)
+                part_path.unlink()
+                return DLResult.DUPLICATE
+            except FileExistsError:
+                # another download took the name since it was checked
+                return name_taken(part_path, link)
+            except OSError:
+                # the filesystem can't do hard links, store it again
+                pass
+        if not place_new_file(part_path, file_path):
+            return name_taken(part_path, link)
+    history.put_content(link.hash, file_path)
+    return res_code
+
+
+def name_taken(part_path, link):
+    """handles a file that appeared at link.full_path while a download
+    was being placed there
+
+    returns DUPLICATE if it's the same file, otherwise COLLISION
+    """
+    part_path.unlink()
+    if hash_file(link.full_path).hexdigest() == link.hash:
+        return DLResult.DUPLICATE
+    return DLResult.COLLISION
+
+
+def place_new_file(part_path, file_path):
+    """moves part_path to file_path, unless something is already there
+
+    the check and the move are a single step, so two downloads that
+    save to the same name at once can't overwrite each other
+    returns False if file_path already exists
+    """
+    try:
+        hard_link(part_path, file_path)
+    except FileExistsError:
+        return False
+    except OSError:
+        # no hard links here; claim the name, then move into it
+        try:
+            os.close(os.open(
+                file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            return False
+        part_path.replace(file_path)
+        return True
+    part_path.unlink()
+    return True
+
+
+def can_split(response, validator, part_path, args):
+    """checks if a file should be downloaded in parts, with download_ranges
+
+    it should if the server takes byte ranges, the file is at least
+    args.split_size MB, and there is a validator to make sure every part
+    comes from the same version. A partial file from a previous try is
+    resumed instead.
+    """
+    if args.split_parts < 2 or args.split_size <= 0:
+        return False
+    if response.status_code != 200 or validator is None:
+        return False
+    if response.headers.get('accept-ranges', '').lower() != 'bytes':
+        return False
+    # a compressed response's length isn't the length of the file
+    if 'content-encoding' in response.headers or part_path.exists():
+        return False
+    size = int(response.headers.get('content-length', 0))
+    return size >= args.split_size * 1024 * 1024
+
+
+def download_range(session, url, path, start, end, validator):
+    """downloads bytes start to end (inclusive) of url into the same
+    place in path
+
+    a part that breaks is picked up where it stopped
+    returns False if the server stopped sending ranges, which means the
+    file has changed
+    """
+    offset = start
+    for attempt in range(session.retries + 1):
+        headers = {'Range': f'bytes={offset}-{end}', 'If-Range': validator}
+        try:
+            with session.get(url, headers=headers, stream=True) as result:
+                if result.status_code != 206:
+                    return False
+                with path.open('r+b') as file:
+                    file.seek(offset)
+                    for chunk in result.iter_content(download_chunk_size):
+                        file.write(chunk)
+                        offset += len(chunk)
+            if offset > end:
+                profiler.count('bytes written', end + 1 - start)
+                return True
+            # the connection closed early without an error
+            raise requests.exceptions.ChunkedEncodingError(
+                f'got {offset - start} of {end + 1 - start} bytes')
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError):
+            if attempt == session.retries:
+                raise
+            session.wait_to_retry(attempt)
+
+
+def download_ranges(session, url, path, size, validator, parts):
+    """downloads url into path in parts, each over its own connection
+
+    path is made full size first, and each part is written in place,
+    so they can finish in any order
+    validator: ETag or Last-Modified value of the file, so every part
+        comes from the same version
+    returns the sha256 of the whole file, or None if the file changed
+        part way through
+    """
+    with path.open('wb') as file:
+        file.truncate(size)
+    step = -(-size // parts)
+    with profiler.phase('download'), \
+            ThreadPoolExecutor(max_workers=parts) as executor:
+        futures = [
+            executor.submit(download_range, session, url, path, start,
+                            min(start + step, size) - 1, validator)
+            for start in range(0, size, step)
+        ]
+        finished = [future.result() for future in futures]
+    if not all(finished):
+        path.unlink()
+        return None
+    # the parts arrived out of order, so hash the file once it's whole
+    return hash_file(path).hexdigest()
+
+
+def stream_with_retries(session, response, part_path, validator):
+    """writes a response's file into part_path, retrying if it breaks
+
+    session: the Transport the response came from
+    validator: ETag or Last-Modified value of the file, or None. With
+        one, a broken download picks up where it stopped; without one,
+        it starts over
+    returns the sha256 of the whole file
+    """
+    resume = validator is not None and part_path.exists()
+    for attempt in range(session.retries + 1):
+        try:
+            if attempt == 0 and not resume:
+                return write_chunks(
+                    response, part_path, 'wb', sha256()).hexdigest()
+            response.close()
+            if validator is None and part_path.exists():
+                part_path.unlink()
+            return stream_to_file(
+                session, response.url, part_path, validator or '')
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError):
+            if attempt == session.retries:
+                raise
+            session.wait_to_retry(attempt)
+
+
+def dowload_file(session, link, history, args):
+    """uses requests to download a file
+
+    safe to call from several threads at once
+    session: a Transport, with blackboard cookies
+    args: the parsed arguments object
+    returns a DLResult; FAILED if the file could not be downloaded,
+        even after retrying
+    """
+    profiler.set_where(link.save_path)
+    try:
+        return try_download(session, link, history, args)
+    except requests.RequestException as error:
+        print(f'\033[KI could not download "{link.name}": {error}')
+        return DLResult.FAILED
+
+
+def skip_reason(link, args, file_name=None, size=None):
+    """checks a file against the --skip-ext, --skip-glob and --max-size
+    rules, so it can be skipped before it is downloaded
+
+    file_name: name the file is saved as, if it is known yet
+    size: the file's Content-Length in bytes, if it is known yet
+    returns why the file should be skipped, or None
+    """
+    names = [link.name] if file_name is None else [link.name, file_name]
+    for name in names:
+        ext = Path(name).suffix.lower().lstrip('.')
+        if ext and ext in args.skip_ext:
+            return f'.{ext} files are skipped'
+    try:
+        save_path = link.save_path.relative_to(args.save)
+    except ValueError:
+        save_path = link.save_path
+    for pattern in args.skip_glob:
+        for name in names:
+            if fnmatch(name, pattern) or \
+                    fnmatch((save_path / name).as_posix(), pattern):
+                return f'it matches "{pattern}"'
+    if size is not None and args.max_size > 0 and \
+            size > args.max_size * 1024 * 1024:
+        return f'it is bigger than {args.max_size:g} MB'
+    return None
+
+
+def skip_courses(courses, args):
+    """returns the courses left by the --course and --skip-course rules"""
+    result = []
+    for course in courses:
+        if (args.course and course.name not in args.course) or \
+                course.name in args.skip_course:
+            print(f'*SKIPPED* {course.name}')
+            continue
+        result.append(course)
+    return result
+
+
+def try_download(session, link, history, args):
+    """does the work of dowload_file, raising if a request fails"""
+    # look for link in history
+    dupe = history.get(link.url)
+    # the file's name is only known for sure once it has been saved
+    # before, but the link's name can be enough to skip it
+    file_name = None
+    if dupe is not None and dupe['full_path'] is not None:
+        file_name = Path(dupe['full_path']).name
+    if skip_reason(link, args, file_name) is not None:
+        return DLResult.SKIPPED
+    with profiler.phase('check'):
+        response = conditional_get(session, link, dupe)
+    with response:
+        if response.status_code == 304:
+            return DLResult.DUPLICATE
+        if response.status_code >= 400:
+            # don't save the error page as the file
+            print(f'\033[KI could not download "{link.name}":'
+                  f' {response.status_code} {response.reason}')
+            return DLResult.FAILED
+        link.set_lastmod(response.headers.get('last-modified'))
+        link.etag = response.headers.get('etag')
+        link.resolved_url = response.url
+        # compare link's validators to historical ones, in case the
+        # server ignored the conditional request
+        if dupe is not None and is_unchanged(link, dupe):
+            return DLResult.DUPLICATE
+        file_name = unquote(response.url.rsplit('/', 1)[1])
+        # check again now that the file's name and size are known,
+        # before any of it is downloaded
+        size = response.headers.get('content-length')
+        if 'content-encoding' in response.headers or size is None:
+            size = None
+        else:
+            size = int(size)
+        if skip_reason(link, args, file_name, size) is not None:
+            return DLResult.SKIPPED
+        # setup the file's full path and create any needed directories
+        link.save_path.mkdir(parents=True, exist_ok=True)
+        # hang onto the full path to report it later
+        link.full_path = link.save_path / file_name
+        # download into a partial file, then move it into place in one
+        # step so an interrupted download never looks finished
+        validator = link.etag or response.headers.get('last-modified')
+        part_path = get_part_path(link, validator or '')
+        link.hash = None
+        if can_split(response, validator, part_path, args):
+            response.close()
+            # kept apart from part_path, since it is full size from the
+            # start and can't be resumed like a single stream
+            range_path = part_path.with_name(
+                f'{part_path.stem}.ranges.part')
+            link.hash = download_ranges(
+                session, response.url, range_path,
+                int(response.headers['content-length']), validator,
+                args.split_parts)
+            if link.hash is not None:
+                part_path = range_path
+            else:
+                # it changed while downloading, start over in one piece
+                link.hash = stream_to_file(
+                    session, response.url, part_path, '')
+        if link.hash is None:
+            # a partial file with a validator is resumed, not started
+            # over
+            link.hash = stream_with_retries(
+                session, response, part_path, validator)
+    if dupe is not None and dupe['hash'] == link.hash:
+        # the server had no validators, but the contents are the same.
+        # The file isn't put back, in case it was moved on purpose
+        part_path.unlink()
+        res_code = DLResult.DUPLICATE
+    else:
+        res_code = place_file(
+            part_path, link, dupe, history, args.keep_versions)
+    # add link to history or update validators; collisions are left
+    # out, so they are tried again next time
+    if res_code != DLResult.COLLISION:
+        history.put(link)
+    return res_code
+
+
+def download_links(links, highlighter, session, history, args, totals,
+                   visited):
+    """uses requests to download files, shows a progress bar
+
+    links: a list of Link objects
+    highlighter: a Highlighter for the page the links are on
+    history: a History object with prevoius download history
+    args: the parsed arguments object; args.jobs files are downloaded
+        at the same time
+    totals: the run's counters, added to as each file finishes, so they
+        are right even if the page is interrupted
+    visited: the Visited of this run, each file's result is recorded in
+        it
+    returns a list of counters for just this page
+    """
+    # set up download tracking variables
+    counters = [0]*len(DLResult)
+    # watch for collisions
+    collided = []
+    # set progress bar length
+    prog_len = get_terminal_size().columns-2
+    # downloads happen in worker threads; the WebDriver is not thread
+    # safe, so results are styled here as each download finishes
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {
+            executor.submit(dowload_file, session, link, history, args):
+            link
+            for link in links
+        }
+        try:
+            for count, future in enumerate(as_completed(futures)):
+                link = futures[future]
+                res_code = future.result()
+                counters[res_code.value] += 1
+                totals[res_code.value] += 1
+                visited.set_result(link.url, res_code)
+                # mark link to indicate download result to user
+                highlighter.queue(link.element, res_code)
+                # if it's a collision, hang onto the link
+                if res_code == DLResult.COLLISION:
+                    collided.append(link)
+                # draw progress bar
+                progress = (count + 1) * int(prog_len / len(links))
+                print('|{}{}|'.format('#'*progress,
+                                      '-'*(prog_len-progress)),
+                      end='\r')
+        except BaseException:
+            # leaving the with block waits for every queued download,
+            # so only the ones already running are let finish
+            for future in futures:
+                future.cancel()
+            raise
+    highlighter.flush()
     # erase progress bar using a ansi escape code
     # \033[K' clears the row
     print('\033[K', end='\r')
     # TODO let user know how many items downloaded ect
-    # let user know what collided
+    report_collisions(collided, 'on this page')
+    return counters
+
+
+def report_collisions(collided, where):
+    """lets user know what collided
+
+    collided: a list of Links that had a file in the way
+    where: describes where the files were, for the message
+    """
     if len(collided) > 0:
-        print('Some of the files on this page could not download',
+        print(f'Some of the files {where} could not download',
               'beacuse another file was in the way:')
         for link in collided:
             print(f'  ~ "{link.full_path}"')
         print('The associated links are marked with a dotted red',
               'outline if you need to manually download these files.')
+
+
+def get_page_fingerprint(fingerprint, args):
+    """mixes the skip rules into a page's fingerprint
+
+    so a page with skipped files is checked again when the rules change,
+    but not while they stay the same. Without any rules, or on an empty
+    page, there is nothing to mix in
+    """
+    rules = [sorted(args.skip_ext), sorted(args.skip_glob), args.max_size]
+    if fingerprint == empty_fingerprint or not any(rules):
+        return fingerprint
+    return sha256(json.dumps([fingerprint, rules]).encode()).hexdigest()
+
+
+def is_page_unchanged(page_link, fingerprint, history, args):
+    """checks if a page's files can be skipped
+
+    they can if the page's fingerprint matches the one recorded when
+    its files were last checked, and that was less than args.max_age
+    days ago
+    """
+    old_fingerprint, checked = history.get_page(page_link.url)
+    return old_fingerprint == fingerprint and \
+        datetime.now() - checked < timedelta(days=args.max_age)
+
+
+def skip_links(links, highlighter, history, visited):
+    """counts the links of an unchanged page as duplicates
+
+    every file of the page was recorded when it was last checked, except
+    the ones the skip rules left out, so those are counted as skipped.
+    The results are recorded in visited, like downloaded ones
+    returns a list of counters, indexed by DLResult values
+    """
+    counters = [0]*len(DLResult)
+    for link in links:
+        if history.get(link.url) is not None:
+            res_code = DLResult.DUPLICATE
+        else:
+            res_code = DLResult.SKIPPED
+        counters[res_code.value] += 1
+        visited.set_result(link.url, res_code)
+        highlighter.queue(link.element, res_code)
+    highlighter.flush()
     return counters
 
 
-def process_page(page_link, driver, session, history, args):
+def drop_seen_links(links, visited, highlighter):
+    """leaves out links that the current run has already seen
+
+    the same file is often attached in several places, but it only
+    needs to be checked once. Links left out are counted as duplicates,
+    unless their first copy failed, collided or was skipped - then they
+    get the same result.
+    returns the new links, the links left out, and a list of counters
+    """
+    counters = [0]*len(DLResult)
+    new_links = []
+    seen_links = []
+    for link in links:
+        if visited.add(link.url):
+            new_links.append(link)
+            continue
+        seen_links.append(link)
+        res_code = visited.get_result(link.url)
+        if res_code not in retried_results + (DLResult.SKIPPED,):
+            res_code = DLResult.DUPLICATE
+        counters[res_code.value] += 1
+        highlighter.queue(link.element, res_code)
+    return new_links, seen_links, counters
+
+
+def is_retried_elsewhere(seen_links, visited):
+    """checks if the first copy of any of the links left out by
+    drop_seen_links is tried again next run, or isn't finished yet
+
+    if so, the page they are on must be checked again too
+    """
+    return any(visited.get_result(link.url) in retried_results + (None,)
+               for link in seen_links)
+
+
+def get_subfolders(page_link, depth, history, args):
+    """returns the folders of a page to go through next
+
+    folders more than args.max_depth deep are left out
+    """
+    folders = history.get_frontier(page_link.url)
+    if folders and depth >= args.max_depth:
+        print(f'  *TOO DEEP* {len(folders)} folder(s) in {page_link.name}')
+        return []
+    return [(folder, depth + 1) for folder in folders]
+
+
+def process_page(page_link, crawler, session, history, args, visited,
+                 counters):
     """gathers urls and downloads file from a page, handles folders
 
     page_link: link object
-    driver: a selenium WebDriver
-    session: a requests Session, with blackboard cookies
-    history: the JSON download history
+    crawler: a BrowserCrawler or HTTPCrawler to read the page with
+    session: a Transport, with blackboard cookies
+    history: the download History
     args: the parsed arguments object
+    visited: the Visited pages and files of this run; each is only
+        gone through once
+    counters: a list of counters, indexed by DLResult values, added to
+        as each file finishes
 
-    returns a list of counters, indexed by DLResult values
+    folders are gone through depth first, up to args.max_depth deep.
+    Pages finished by an interrupted run are not loaded again, but
+    their folders are still gone through
     """
-    print(f'  {page_link.name}')
-    driver.get(page_link.url)
-    gather_results = gather_links(page_link, driver, args.delay)
-    counters = download_links(
-        gather_results['links'], driver, session, history)
-    # save history after every page
-    try:
-        with args.historypath.open('w') as file:
-            json.dump(history, file, indent=4)
-    except IOError:
-        print('failed to save download history! You may want to',
-              'investigate before continuing to the next page.')
+    # a stack instead of recursion, so deep folders can't overflow it
+    stack = [(page_link, 0)]
+    while stack:
+        page_link, depth = stack.pop()
+        if not visited.add(page_link.url):
+            print(f'  *SEEN* {page_link.name}')
+            continue
+        if history.is_done(page_link.url):
+            print(f'  *DONE* {page_link.name}')
+        else:
+            print(f'  {page_link.name}')
+            process_one_page(
+                page_link, crawler, session, history, args, visited,
+                counters)
+        # reversed, so the first folder is popped first
+        stack.extend(reversed(
+            get_subfolders(page_link, depth, history, args)))
+
+
+def process_one_page(page_link, crawler, session, history, args,
+                     visited, counters):
+    """gathers urls and downloads files from a single page
+
+    its folders are recorded in the frontier, but not gone through
+    counters: a list of counters, indexed by DLResult values, added to
+        as each file finishes
+    """
+    gather_results = crawler.gather(page_link)
+    if gather_results is None:
+        # it couldn't be read, so leave it for next time
+        return
+    history.add_frontier(gather_results['folders'], page_link.url)
+    fingerprint = get_page_fingerprint(gather_results['fingerprint'], args)
+    links, seen_links, seen_counters = drop_seen_links(
+        gather_results['links'], visited, crawler.highlighter)
+    for i, s_ctr in enumerate(seen_counters):
+        counters[i] += s_ctr
+    if is_page_unchanged(page_link, fingerprint, history, args):
+        skip_counters = skip_links(
+            links, crawler.highlighter, history, visited)
+        for i, p_ctr in enumerate(skip_counters):
+            counters[i] += p_ctr
+    else:
+        page_counters = download_links(
+            links, crawler.highlighter, session, history, args, counters,
+            visited)
+        # collisions and failures are tried again, so the page is
+        # checked again - even if they happened on another page
+        if not any(page_counters[res_code.value]
+                   for res_code in retried_results) and \
+                not is_retried_elsewhere(seen_links, visited):
+            history.put_page(page_link.url, fingerprint)
+    history.mark_done(page_link.url)
     if not args.auto:
         # wait for user input
         input('Press enter here once you are ready to move on: ')
         # erase prompt using ansi escape codes since a newline was printed
         # '\033[A' moves cursor up once, '\033[K' clears the row
         print('\033[A\033[K', end='\r')
-    for folder_link in gather_results['folders']:
-        sub_counters = process_page(
-            folder_link, driver, session, history, args)
-        for i, s_ctr in enumerate(sub_counters):
-            counters[i] += s_ctr
-    return counters
+
+
+def get_course_pages(course, crawler, history, args):
+    """returns the navpane Links of a course that should be processed
+
+    the navpane is only loaded the first time; after that (or when
+    resuming) the pages are read from the history's frontier
+    """
+    pages = history.get_frontier(course.url)
+    if pages:
+        return pages
+    for page in crawler.navpane(course):
+        # a few pages have no (downloadable) content, skip them
+        if page.name in args.ignore:
+            print(f'  *SKIPPED* {page.name}')
+            continue
+        pages.append(page)
+    history.add_frontier(pages, course.url)
+    return pages
+
+
+def process_courses(courses, crawler, session, history, args, counters):
+    """goes through every page of every course, one page at a time
+
+    counters: a list of counters, indexed by DLResult values, added to
+        as each page finishes
+    """
+    visited = Visited()
+    for course in courses:
+        if history.is_done(course.url):
+            print(f'*DONE* {course.name}')
+            continue
+        print(f'{course.name}')
+        for page in get_course_pages(course, crawler, history, args):
+            process_page(
+                page, crawler, session, history, args, visited, counters)
+        history.mark_done(course.url)
+
+
+async def crawl_page(page_link, crawler, history, args, counters, queue,
+                     crawl_executor, visited):
+    """pipeline producer: gathers a page's links and pushes them onto
+    queue, then does the same for its folders
+
+    waits whenever queue is full, so page reading never gets too far
+    ahead of the downloads. Each link is queued along with a counter
+    of how many of its page's links are left, so the page can be
+    marked done (and its fingerprint saved) once the last one is
+    downloaded. Unchanged pages are counted without queueing anything.
+    Pages and files in visited are left out, like in process_page.
+    """
+    loop = asyncio.get_running_loop()
+    stack = [(page_link, 0)]
+    while stack:
+        page_link, depth = stack.pop()
+        if not visited.add(page_link.url):
+            print(f'  *SEEN* {page_link.name}')
+            continue
+        if history.is_done(page_link.url):
+            print(f'  *DONE* {page_link.name}')
+        else:
+            print(f'  {page_link.name}')
+            gather_results = await loop.run_in_executor(
+                crawl_executor, crawler.gather, page_link)
+            # None means the page couldn't be read, try it next time
+            if gather_results is not None:
+                history.add_frontier(
+                    gather_results['folders'], page_link.url)
+                # drop_seen_links highlights through the WebDriver, which
+                # lives in the crawl thread. The styles must be applied
+                # before the next page loads, or their elements go stale
+                links, seen_links, seen_counters = \
+                    await loop.run_in_executor(
+                        crawl_executor, drop_seen_links,
+                        gather_results['links'], visited,
+                        crawler.highlighter)
+                await loop.run_in_executor(
+                    crawl_executor, crawler.highlighter.flush)
+                for i, s_ctr in enumerate(seen_counters):
+                    counters[i] += s_ctr
+                fingerprint = get_page_fingerprint(
+                    gather_results['fingerprint'], args)
+                if is_page_unchanged(
+                        page_link, fingerprint, history, args):
+                    skip_counters = await loop.run_in_executor(
+                        crawl_executor, skip_links, links,
+                        crawler.highlighter, history, visited)
+                    for i, p_ctr in enumerate(skip_counters):
+                        counters[i] += p_ctr
+                    links = []
+                elif not links and \
+                        not is_retried_elsewhere(seen_links, visited):
+                    history.put_page(page_link.url, fingerprint)
+                if not links:
+                    history.mark_done(page_link.url)
+                remaining = {'page': page_link, 'count': len(links),
+                             'fingerprint': fingerprint, 'collided': False,
+                             'seen': seen_links}
+                for link in links:
+                    await queue.put((link, remaining))
+        stack.extend(reversed(
+            get_subfolders(page_link, depth, history, args)))
+
+
+async def download_worker(queue, session, history, args, counters,
+                          collided, download_executor, visited):
+    """pipeline consumer: downloads Links from queue until it gets None
+
+    each file's result is recorded in visited
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        link, remaining = item
+        res_code = await loop.run_in_executor(
+            download_executor, dowload_file, session, link, history, args)
+        counters[res_code.value] += 1
+        visited.set_result(link.url, res_code)
+        if res_code == DLResult.COLLISION:
+            collided.append(link)
+        if res_code in retried_results:
+            remaining['collided'] = True
+        remaining['count'] -= 1
+        if remaining['count'] == 0:
+            page_url = remaining['page'].url
+            if not remaining['collided'] and \
+                    not is_retried_elsewhere(remaining['seen'], visited):
+                history.put_page(page_url, remaining['fingerprint'])
+            history.mark_done(page_url)
+
+
+async def pipeline(courses, crawler, session, history, args, counters,
+                   collided):
+    """reads course pages and downloads their files at the same time
+
+    pages are read one at a time in a single thread (a WebDriver can
+    only do one thing at once), while args.jobs workers download the
+    links found so far. counters and collided are filled in as files
+    finish, so they are still useful if the pipeline is interrupted.
+    If the crawl or any download raises, the pipeline stops and the
+    exception is raised, like it would be without the pipeline.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=args.jobs * 4)
+    visited = Visited()
+    crawl_executor = ThreadPoolExecutor(max_workers=1)
+    download_executor = ThreadPoolExecutor(max_workers=args.jobs)
+    workers = [
+        asyncio.ensure_future(download_worker(
+            queue, session, history, args, counters, collided,
+            download_executor, visited))
+        for _ in range(args.jobs)
+    ]
+
+    async def crawl_courses():
+        for course in courses:
+            if history.is_done(course.url):
+                print(f'*DONE* {course.name}')
+                continue
+            print(f'{course.name}')
+            pages = await loop.run_in_executor(
+                crawl_executor, get_course_pages, course, crawler, history,
+                args)
+            for page in pages:
+                await crawl_page(
+                    page, crawler, history, args, counters, queue,
+                    crawl_executor, visited)
+        # one stop signal per worker, after everything else in the queue
+        for _ in workers:
+            await queue.put(None)
+
+    producer = asyncio.ensure_future(crawl_courses())
+    tasks = [producer] + workers
+    try:
+        # a dead worker would leave the producer waiting on a full
+        # queue forever, so watch every task and stop at the first error
+        done, _ = await asyncio.wait(
+            tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            # raises the task's exception, if it had one
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        # downloads already running are allowed to finish
+        crawl_executor.shutdown(wait=True)
+        download_executor.shutdown(wait=True)
+
+
+def run_pipeline(courses, crawler, session, history, args, counters):
+    """runs the pipeline
+
+    counters: a list of counters, indexed by DLResult values, added to
+        as each file finishes
+    """
+    collided = []
+    try:
+        asyncio.run(pipeline(
+            courses, crawler, session, history, args, counters, collided))
+    finally:
+        report_collisions(collided, 'in your courses')
+
+
+def crawl_worker(courses, cookies, history_path, args, profile_start):
+    """goes through some of the courses in a headless browser of its own
+
+    runs in a separate process. The browser is given a copy of the
+    login cookies, so it doesn't need to log in.
+    cookies: cookies from the logged in WebDriver
+    history_path: the history database, shared by every worker
+    profile_start: the main process's profiler start time
+    returns a list of counters, indexed by DLResult values, the
+    session's retry and throttle counts, and the profiler's events
+    """
+    if args.profile is not None:
+        profiler.enable(args.save, profile_start)
+    # the process may have been started without main()
+    import_crawl_modules()
+    driver = setup_driver(args, headless=True)
+    try:
+        # cookies can only be set for the site that is loaded
+        driver.get(args.bb_url)
+        add_cookies(driver, cookies)
+        session = setup_session(cookies, args)
+        history = History(history_path)
+        waiter = Waiter(args.delay, history)
+        crawler = BrowserCrawler(
+            driver, waiter, Highlighter(driver, enabled=False))
+        counters = [0]*len(DLResult)
+        if args.pipeline:
+            run_pipeline(courses, crawler, session, history, args, counters)
+        else:
+            process_courses(
+                courses, crawler, session, history, args, counters)
+        waiter.save()
+        history.close()
+    finally:
+        driver.quit()
+    return counters, (session.retried, session.throttled), profiler.events
+
+
+def crawl_in_parallel(courses, cookies, history_path, args, counters,
+                      session):
+    """splits the courses between args.browsers worker processes
+
+    counters: a list of counters, indexed by DLResult values, added to
+        as each worker finishes
+    session: the main Transport, the workers' retry and throttle counts
+        are added to it
+    """
+    with ProcessPoolExecutor(max_workers=args.browsers) as executor:
+        futures = [
+            executor.submit(crawl_worker, courses[i::args.browsers],
+                            cookies, history_path, args, profiler.start)
+            for i in range(min(args.browsers, len(courses)))
+        ]
+        for future in as_completed(futures):
+            w_counters, (w_retried, w_throttled), w_events = \
+                future.result()
+            for i, w_ctr in enumerate(w_counters):
+                counters[i] += w_ctr
+            session.retried += w_retried
+            session.throttled += w_throttled
+            profiler.events.extend(w_events)
+
+
+def parse_history_args(argv):
+    # every command takes these
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        '-s', '--save', metavar='path', default='.',
+        help='directory your downloads are saved in')
+    common.add_argument(
+        '--historypath', '--history', metavar='file',
+        default='BlackboardDuster.db',
+        help='path to blackboard duster history database. Relative' +
+        ' to download directory unless path is absolute')
+    parser = argparse.ArgumentParser(
+        prog='blackboard_duster.py',
+        description='Looks through the download history, without' +
+        ' opening a browser or going online')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    list_parser = commands.add_parser(
+        'list', parents=[common],
+        help='list downloaded files, by course')
+    list_parser.add_argument(
+        'course', nargs='?', default=None,
+        help='only list the files of this course')
+    changed_parser = commands.add_parser(
+        'changed', parents=[common],
+        help='list files that changed on Blackboard since a date')
+    changed_parser.add_argument(
+        'since', metavar='date', type=datetime.fromisoformat,
+        help='a date like 2020-01-31, or 2020-01-31T12:00')
+    verify_parser = commands.add_parser(
+        'verify', parents=[common],
+        help='check that downloaded files are still on disk.' +
+        ' Exits with status 1 if any are missing')
+    verify_parser.add_argument(
+        '--hash', action='store_true',
+        help='also check that their contents have not changed. Slower,' +
+        ' every file is read')
+    args = parser.parse_args(argv)
+    args.save = Path(args.save)
+    args.historypath = Path(args.historypath)
+    if not args.historypath.is_absolute():
+        args.historypath = args.save / args.historypath
+    return args
+
+
+def get_course_name(entry, save_root):
+    """returns the course a history entry was downloaded from"""
+    save_path = Path(entry['save_path'])
+    try:
+        return save_path.relative_to(save_root).parts[0]
+    except (ValueError, IndexError):
+        return save_path.as_posix()
+
+
+def get_entry_path(entry):
+    """returns where a history entry's file was saved
+
+    entries saved by older versions don't know their file name, so
+    this is only their directory
+    """
+    if entry['full_path'] is None:
+        return Path(entry['save_path'])
+    return Path(entry['full_path'])
+
+
+def list_entries(entries, args):
+    """prints history entries grouped by course"""
+    course = None
+    for entry in entries:
+        entry_course = get_course_name(entry, args.save)
+        if entry_course != course:
+            course = entry_course
+            print(course)
+        print(f'  {get_entry_path(entry).as_posix()}')
+
+
+def verify_entries(entries, check_hash):
+    """checks that the files in the history are still on disk
+
+    check_hash: if True, also compare each file's sha256 to the one it
+        had when it was downloaded
+    returns the number of files that are missing or changed
+    """
+    bad = 0
+    for entry in entries:
+        path = get_entry_path(entry)
+        if entry['full_path'] is None:
+            # can't tell which file it was, but its folder should exist
+            if not path.is_dir():
+                print(f'missing: {path.as_posix()}/')
+                bad += 1
+        elif not path.is_file():
+            print(f'missing: {path.as_posix()}')
+            bad += 1
+        elif check_hash and entry['hash'] is not None and \
+                hash_file(path).hexdigest() != entry['hash']:
+            print(f'changed: {path.as_posix()}')
+            bad += 1
+    return bad
+
+
+def history_main(argv):
+    """runs one of the history_commands
+
+    returns the exit status
+    """
+    args = parse_history_args(argv)
+    if not args.historypath.exists():
+        print(f'I could not find a history at "{args.historypath}"')
+        return 1
+    # monitoring scripts shouldn't change what they are looking at
+    history = History(args.historypath, read_only=True)
+    entries = history.all()
+    history.close()
+    if args.command == 'list':
+        if args.course is not None:
+            entries = [entry for entry in entries
+                       if get_course_name(entry, args.save) == args.course]
+        list_entries(entries, args)
+    elif args.command == 'changed':
+        entries = [entry for entry in entries
+                   if entry['lastmod'] is not None and
+                   entry['lastmod'] >= args.since]
+        entries.sort(key=lambda entry: entry['lastmod'], reverse=True)
+        for entry in entries:
+            print(f'{entry["lastmod"]:%Y-%m-%d %H:%M}'
+                  f'  {get_entry_path(entry).as_posix()}')
+    elif args.command == 'verify':
+        bad = verify_entries(entries, args.hash)
+        print(f'{len(entries) - bad} of {len(entries)} files are ok')
+        return 1 if bad else 0
+    return 0
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in history_commands:
+        sys.exit(history_main(sys.argv[1:]))
     args = parse_args()
+    import_crawl_modules()
+    if args.profile is not None:
+        profiler.enable(args.save)
     history = setup_history(args.historypath)
-    # set up the WebDriver
+    waiter = Waiter(args.delay, history)
+    courses = []
+    if args.resume:
+        courses = history.get_frontier('')
+        if courses:
+            print('Picking up where the last run stopped.')
+    if not courses:
+        # starting from scratch, forget any interrupted run
+        history.clear_frontier()
+    # try the login saved by an earlier run
+    session = None
+    cookies = None
+    if args.session_cache is not None:
+        cookies = load_session_cache(args.session_cache)
+    if cookies is not None:
+        session = setup_session(cookies, args)
+        home = check_session(session, args.bb_url)
+        if home is None:
+            print('Your saved login has expired.')
+            session = None
+        else:
+            print('You are still logged in from last time!')
+            if not courses:
+                courses = links_from_courses(
+                    scrape_courses(*home), args.save)
     driver = None
-    if args.webdriver == 'firefox':
-        # driver = webdriver.Firefox(firefox_profile=get_ff_profile(args))
-        driver = webdriver.Firefox()
-    elif args.webdriver == 'chrome':
-        # driver = webdriver.Chrome(options=get_ch_options(args))
-        driver = webdriver.Chrome()
+    # the browser can be skipped entirely if the saved login works, the
+    # course list was found without it, and it isn't needed to crawl
+    if session is None or not courses or not args.no_browser_crawl:
+        # set up the WebDriver - nobody needs to see it if no login
+        # is needed
+        headless = args.lean and session is not None
+        driver = setup_driver(args, headless=headless)
+        print("here we go!")
+        driver.get(args.bb_url)
+        if session is not None:
+            add_cookies(driver, cookies)
+            driver.get(args.bb_url)
+            if headless and not is_home_title(driver.title):
+                # nobody can log in to a window they can't see
+                print('The browser did not take your saved login, so I' +
+                      ' am opening one you can log in with.')
+                driver.quit()
+                driver = setup_driver(args)
+                driver.get(args.bb_url)
+        manual_login(driver)
+        cookies = driver.get_cookies()
+        session = setup_session(cookies, args)
+        if args.session_cache is not None:
+            save_session_cache(args.session_cache, cookies)
+        print('Alright, I can drive from here.')
+        # links are visible behind the cookie notice, but it gets annoying
+        # plus, there might be legal implications - so accept and move on
+        accept_cookies(driver, waiter)
+        if not courses:
+            courses = get_courses_info(driver, waiter, args.save)
+    courses = skip_courses(courses, args)
+    history.add_frontier(courses, '')
+    if driver is None:
+        crawler = HTTPCrawler(session)
+    elif args.browsers > 1 and not args.no_browser_crawl:
+        # the worker browsers take it from here
+        driver.quit()
+        driver = None
+        crawler = None
+    elif args.no_browser_crawl:
+        # the browser has done its job, the rest is plain HTTP
+        driver.quit()
+        driver = None
+        crawler = HTTPCrawler(session)
     else:
-        print(
-            f'sorry, but {args.webdriver} is not a supported WebDriver. Aborting')
-        exit()
-
-    print("here we go!")
-    # choose a nice size - the navpane is invisible at small widths,
-    # but selenium can still see its elements
-    driver.set_window_size(600, 500)
-    driver.get(args.bb_url)
-    manual_login(driver)
-    session = setup_session(driver)
-    print('Alright, I can drive from here.')
-    # links are visible behind the cookie notice, but it gets annoying
-    # plus, there might be legal implications - so accept and move on
-    accept_cookies(driver, args.delay)
-    courses = get_courses_info(driver, args.delay, args.save)
+        highlighter = Highlighter(driver, not args.no_highlight)
+        crawler = BrowserCrawler(driver, waiter, highlighter)
     print(f'I found {len(courses)} courses. I will go through each one now!')
     counters = [0]*len(DLResult)
-    for course in courses:
-        print(f'{course.name}')
-        navpane = get_navpane_info(driver, course, args.delay)
-        for page in navpane:
-            # a few pages have no (downloadable) content, skip them
-            if page.name in args.ignore:
-                print(f'  *SKIPPED* {page.name}')
-                continue
-            page_counters = process_page(
-                page, driver, session, history, args)
-            for i, p_ctr in enumerate(page_counters):
-                counters[i] += p_ctr
+    try:
+        if crawler is None:
+            crawl_in_parallel(
+                courses, cookies, history.path, args, counters, session)
+        elif args.pipeline:
+            run_pipeline(courses, crawler, session, history, args, counters)
+        else:
+            process_courses(courses, crawler, session, history, args, counters)
+        # everything is done, the next run starts from scratch
+        history.clear_frontier()
+    except KeyboardInterrupt:
+        print('\nStopping early! Use --resume to pick up where I left off.')
+    except LoginExpired:
+        print('\nYour login expired part way through! Run me again with' +
+              ' --resume to log in and pick up where I left off.')
     print('#'*get_terminal_size().columns)
     print('I am all done! Here are the stats:')
     for res_code in DLResult:
         print(f'  {res_code.name}: {counters[res_code.value]}')
-    driver.quit()
+    print(f'  RETRIED: {session.retried}')
+    print(f'  THROTTLED: {session.throttled}')
+    if args.profile is not None:
+        profiler.print_summary()
+        profiler.write_trace(args.profile, args.profile_format)
+        print(f'Every timing is saved in "{args.profile}"')
+    waiter.save()
+    history.close()
+    if driver is not None:
+        driver.quit()
 # end main()
 
 